@@ -16,3 +16,5 @@ _conda_supported = _conda_version >= _conda_base
 assert _conda_supported, 'Minimum supported conda version is {}, got {}.'.format(_conda_base, _conda_version)
 
 manifest_branch_prefix = 'manifest/'
+# The notes ref under which resolve records the fingerprint of each manifest.
+fingerprint_notes_ref = 'refs/notes/conda-gitenv'
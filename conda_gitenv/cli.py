@@ -7,6 +7,7 @@ import conda_gitenv.resolve as resolve
 import conda_gitenv.tag_dates as tag_dates
 import conda_gitenv.label_tag as label_tag
 import conda_gitenv.deploy as deploy
+import conda_gitenv.garbage_collect as garbage_collect
 
     
 def main():
@@ -17,6 +18,7 @@ def main():
     tag_dates.configure_parser(subparsers.add_parser('autotag'))
     label_tag.configure_parser(subparsers.add_parser('autolabel'))
     deploy.configure_parser(subparsers.add_parser('deploy'))
+    garbage_collect.configure_parser(subparsers.add_parser('gc'))
 
     args = parser.parse_args()
     return args.function(args)
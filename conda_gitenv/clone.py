@@ -0,0 +1,101 @@
+from __future__ import print_function
+
+import json
+import os
+import shutil
+
+from conda.core.portability import update_prefix
+from conda.gateways.disk.create import mkdir_p
+from conda.gateways.disk.read import read_has_prefix
+
+from conda_gitenv.extract import is_extracted
+
+
+def link_file(source, target, copy=False):
+    """
+    Hardlink the source file to the target where possible (sharing the
+    inode with the package cache if the source prefix was itself
+    hardlinked), otherwise copy it. Symlinks are recreated as such.
+
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+    if not copy:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            # For example, the prefixes are on different filesystems.
+            pass
+    shutil.copy2(source, target)
+
+
+def clone_package(source, target, dist_name, pkgs_dir):
+    """
+    Materialise the package of the given distribution name, which is linked
+    into the source prefix, into the target prefix without a conda
+    transaction. Return whether the package could be cloned.
+
+    Files are hardlinked from the source prefix, other than those which
+    have the prefix embedded in them, which are instead copied from the
+    extracted package and have the target prefix written into them, and
+    those which the package says mustn't be linked, which are copied.
+    Packages whose installation depends on more than their files (noarch
+    packages, and those with post-link scripts) are not cloned.
+
+    """
+    meta_path = os.path.join(source, 'conda-meta', dist_name + '.json')
+    extracted = os.path.join(pkgs_dir, dist_name)
+    if not os.path.isfile(meta_path) or not is_extracted(extracted):
+        return False
+    with open(meta_path, 'r') as fh:
+        meta = json.load(fh)
+    if meta.get('noarch'):
+        return False
+    for script in [os.path.join('bin', '.{}-post-link.sh'),
+                   os.path.join('Scripts', '.{}-post-link.bat')]:
+        if os.path.exists(os.path.join(extracted,
+                                       script.format(meta['name']))):
+            return False
+
+    has_prefix_path = os.path.join(extracted, 'info', 'has_prefix')
+    has_prefix = {}
+    if os.path.isfile(has_prefix_path):
+        has_prefix = read_has_prefix(has_prefix_path)
+    no_link_path = os.path.join(extracted, 'info', 'no_link')
+    no_link = set()
+    if os.path.isfile(no_link_path):
+        with open(no_link_path, 'r') as fh:
+            no_link = set(line.strip() for line in fh if line.strip())
+
+    for path in meta.get('files', []):
+        target_path = os.path.join(target, path)
+        mkdir_p(os.path.dirname(target_path))
+        if path in has_prefix:
+            placeholder, mode = has_prefix[path]
+            shutil.copy2(os.path.join(extracted, path), target_path)
+            update_prefix(target_path, target, placeholder, mode)
+        else:
+            link_file(os.path.join(source, path), target_path,
+                       copy=path in no_link)
+    mkdir_p(os.path.join(target, 'conda-meta'))
+    shutil.copy2(meta_path, os.path.join(target, 'conda-meta',
+                                         dist_name + '.json'))
+    return True
+
+
+def clone_prefix(source, target, dist_names, pkgs_dir):
+    """
+    Clone the packages of the given distribution names from the source
+    prefix into the (new) target prefix, returning the set of those which
+    were cloned. The others must be linked into the target as normal.
+
+    """
+    cloned = set()
+    for dist_name in dist_names:
+        if clone_package(source, target, dist_name, pkgs_dir):
+            cloned.add(dist_name)
+    print('Cloned {} of {} packages from {}'.format(len(cloned),
+                                                    len(dist_names), source))
+    return cloned
@@ -1,66 +1,241 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+from collections import OrderedDict
+import contextlib
 from fnmatch import fnmatch
-from functools import wraps
 from glob import glob
+import json
 import os
 import stat
 
 import conda.base.context
 from conda.core.link import UnlinkLinkTransaction
-from conda.core.package_cache import ProgressiveFetchExtract
-from conda.exports import Resolve, fetch_index
-from conda.models.channel import prioritize_channels
+from conda.core.package_cache import PackageCache, ProgressiveFetchExtract
+from conda.exports import fetch_index
+from conda.models.channel import Channel, prioritize_channels
 from conda.models.dist import Dist
+from conda.models.index_record import IndexRecord
 from conda.gateways.disk.create import mkdir_p
-from git import Repo
+from git import TagReference
 import yaml
 
+from conda_gitenv.clone import clone_prefix
+from conda_gitenv.download import download_packages, stream_packages
+from conda_gitenv.extract import (PACKAGE_EXTENSIONS, dist_name,
+                                  extract_packages, is_extracted)
+from conda_gitenv.index import IndexRegistry
 from conda_gitenv.lock import Locked
-from conda_gitenv.resolve import create_tracking_branches, tempdir
+from conda_gitenv.pkg_cache import evict_packages, in_use, mark_used
+from conda_gitenv.pool import pool_imap, positive_int, worker_state
+from conda_gitenv.pkg_store import (fetch_from_stores, in_stores,
+                                    populate_stores)
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.resolve import (cloned_repo, inject_credentials, read_file,
+                                  read_lock)
 from conda_gitenv import manifest_branch_prefix
 
 
 PKG_CACHE_NAME = '.pkg_cache'
-
-
-def tags_by_label(labels_directory):
+# The marker, relative to an environment's prefix, which records that the
+# environment was fully deployed. Not a ".json" file, as conda treats those
+# in conda-meta as package records.
+DEPLOYED_MARKER = os.path.join('conda-meta', '.conda-gitenv-deployed')
+# The assumed download rate (in bytes per second) and time to link a single
+# package (in seconds), from which a deploy plan estimates its duration.
+PLAN_DOWNLOAD_RATE = 10e6
+PLAN_LINK_TIME = 0.2
+
+
+def tags_by_label_tree(commit):
+    """
+    Return the tag of each label committed to the labels directory of the
+    given commit, reading the label files from the commit's tree.
+
+    """
     tags = {}
-    if os.path.isdir(labels_directory):
-        for label_fname in glob(os.path.join(labels_directory, '*.txt')):
-            with open(label_fname, 'r') as fh:
-                tag_name = fh.read().strip()
-            label = os.path.splitext(os.path.basename(label_fname))[0]
-            tags[label] = tag_name
+    try:
+        labels_tree = commit.tree / 'labels'
+    except KeyError:
+        return tags
+    for blob in labels_tree.blobs:
+        label, ext = os.path.splitext(blob.name)
+        if ext == '.txt':
+            tags[label] = blob.data_stream.read().decode('utf-8').strip()
     return tags
 
 
-def tags_by_env(repo):
+def tags_by_env(repo, refs=None):
+    if refs is None:
+        refs = RefSnapshot(repo)
     tags = {}
-    for tag in repo.tags:
+    for tag in refs.tags.values():
         env_name = tag.name.split('-')[1]
         tags.setdefault(env_name, []).append(tag)
     return tags
 
 
-def deploy_tag(repo, tag_name, target, api_user=None, api_key=None,
-               mirror=None):
-    tag = repo.tags[tag_name]
-    # Checkout the tag in a detached head form.
-    repo.head.reference = tag.commit
-    repo.head.reset(working_tree=True)
+def read_deployed_marker(prefix):
+    """
+    Return the contents of the deployed marker of the given environment
+    prefix, or None if the environment hasn't been fully deployed.
+
+    """
+    try:
+        with open(os.path.join(prefix, DEPLOYED_MARKER), 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_deployed_marker(prefix, manifest_sha, pkgs):
+    """
+    Mark the given environment prefix as fully deployed from the manifest
+    blob with the given SHA, containing the given package names.
+
+    """
+    marker = os.path.join(prefix, DEPLOYED_MARKER)
+    # Write then rename, so that a partially written marker is never seen.
+    with open(marker + '.tmp', 'w') as fh:
+        json.dump({'manifest_sha': manifest_sha, 'packages': pkgs}, fh,
+                  indent=2, sort_keys=True)
+    os.rename(marker + '.tmp', marker)
+
+
+def deployed_packages(prefix):
+    """
+    Return the distribution names of the packages of the given deployed
+    prefix, from its deployed marker or otherwise its conda-meta.
+
+    """
+    marker = read_deployed_marker(prefix)
+    if marker is not None:
+        return marker['packages']
+    return [os.path.splitext(os.path.basename(path))[0]
+            for path in glob(os.path.join(prefix, 'conda-meta', '*.json'))]
+
+
+def closest_prefix(target, pkgs):
+    """
+    Return the already deployed prefix alongside the given target prefix
+    (i.e. that of another tag of the same environment) which has the most
+    of the given package names in common, or None if there isn't one.
+
+    """
+    env_dir = os.path.dirname(target)
+    if not os.path.isdir(env_dir):
+        return None
+    pkgs = set(pkgs)
+    closest, most_common = None, 0
+    for name in sorted(os.listdir(env_dir)):
+        prefix = os.path.join(env_dir, name)
+        # Labels are symlinks to the deployed prefixes.
+        if prefix == target or os.path.islink(prefix):
+            continue
+        marker = read_deployed_marker(prefix)
+        if marker is None:
+            continue
+        common = len(pkgs.intersection(marker['packages']))
+        if common > most_common:
+            closest, most_common = prefix, common
+    return closest
+
+
+def deployed_prefixes(target):
+    """
+    Return a dictionary mapping manifest content hash to a fully deployed
+    prefix (of any environment) under the target with that manifest.
+
+    No locks are taken, so the target is left untouched. A prefix being
+    removed loses its marker first, and :func:`reuse_prefix` checks it
+    again under the prefix's lock.
+
+    """
+    prefixes = {}
+    for prefix in sorted(glob(os.path.join(target, '*', '*'))):
+        # Labels (and reused prefixes) are symlinks to deployed prefixes.
+        if os.path.islink(prefix):
+            continue
+        marker = read_deployed_marker(prefix)
+        if marker is not None:
+            prefixes.setdefault(marker['manifest_sha'], prefix)
+    return prefixes
+
+
+def replace_symlink(link, path):
+    """
+    Make the given path a symlink to the given link, atomically replacing
+    any existing symlink there, such that the path never goes missing.
+
+    A uniquely named temporary symlink is renamed over the path, so no
+    lock is needed: concurrent updates of the same path are each atomic,
+    and the last one wins.
+
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(link, tmp)
+    os.rename(tmp, path)
+
+
+def reuse_prefix(prefix, target):
+    """
+    Make the target prefix a (relative) symlink to the given deployed
+    prefix, which has an identical manifest.
+
+    The symlink is made holding the lock of the deployed prefix, so that it
+    can't be removed by :func:`conda_gitenv.garbage_collect.remove_prefix`
+    in the meantime.
+
+    """
+    with Locked(prefix):
+        if read_deployed_marker(prefix) is None:
+            # e.g. It was garbage collected since the deploy was planned.
+            msg = '{} is no longer deployed, so can\'t be reused for {}.'
+            raise RuntimeError(msg.format(prefix, target))
+        mkdir_p(os.path.dirname(target))
+        link = os.path.relpath(prefix, os.path.dirname(target))
+        print('Reusing {} for {}'.format(prefix, target))
+        replace_symlink(link, target)
+
+
+def read_tag(repo, tag_name, target, mirror=None, incremental=True):
+    """
+    Return the keyword arguments of :func:`create_env` which deploy the
+    given tag into its prefix under the target, or None if the tag has
+    already been fully deployed.
+
+    Everything needed is read from the repo here, so that the deployment
+    itself needs no access to the repo (and may be done in another
+    process).
+
+    """
+    # Read the manifest and spec straight from the tagged commit's tree.
+    tag = TagReference(repo, 'refs/tags/{}'.format(tag_name))
+    commit = tag.commit
 
     # Parse tag_name with form "env-<env_name>-<deployed_name>".
     env_name = tag_name.split('-')[1]
     deployed_name = tag_name.split('-', 2)[2]
 
-    manifest_fname = os.path.join(repo.working_dir, 'env.manifest')
-    if not os.path.exists(manifest_fname):
+    try:
+        manifest_blob = commit.tree / 'env.manifest'
+    except KeyError:
         msg = "The tag '{}' doesn't have a manifested environment."
         raise ValueError(msg.format(tag_name))
-    with open(manifest_fname, 'r') as fh:
-        manifest = sorted(line.strip().split('\t') for line in fh)
+
+    # Tags are immutable, so there is nothing to do if this manifest has
+    # already been fully deployed.
+    target = os.path.join(target, env_name, deployed_name)
+    marker = read_deployed_marker(target)
+    if marker is not None and marker['manifest_sha'] == manifest_blob.hexsha:
+        return None
+
+    manifest_text = manifest_blob.data_stream.read().decode('utf-8')
+    manifest = sorted(line.strip().split('\t')
+                      for line in manifest_text.splitlines())
+    spec = yaml.safe_load(read_file(commit, 'env.spec'))
 
     # Replace the channel URL with the mirror URL for each package
     # entry specified in the manifest.
@@ -68,174 +243,597 @@ def deploy_tag(repo, tag_name, target, api_user=None, api_key=None,
         manifest = [[os.path.join(mirror, os.path.basename(channel)), pkg]
                     for channel, pkg in manifest]
 
-    target = os.path.join(target, env_name, deployed_name)
-    create_env(repo, manifest, target, api_user=api_user, api_key=api_key,
-               mirror=mirror)
-
-
-def create_env(repo, pkgs, target, api_user=None, api_key=None, mirror=None):
-    try:
-        # Python3...
-        from urllib.parse import urlparse
-    except ImportError:
-        # Python2...
-        from urlparse import urlparse
+    # A new prefix can be cloned from the closest deployed tag, such that
+    # only the packages which differ need to be linked.
+    base_prefix = None
+    if incremental and not os.path.exists(target):
+        base_prefix = closest_prefix(target, [pkg for _, pkg in manifest])
 
-    with Locked(target):
-        spec_fname = os.path.join(repo.working_dir, 'env.spec')
-        with open(spec_fname, 'r') as fh:
-            spec = yaml.safe_load(fh)
+    return dict(spec=spec, pkgs=manifest, target=target,
+                manifest_sha=manifest_blob.hexsha, records=read_lock(commit),
+                base_prefix=base_prefix)
 
-        channels = spec.get('channels', [])
 
-        # Replace the channel/s specified in the environment specification
-        # with the mirror URL.
+def deploy_tag(repo, tag_name, target, api_user=None, api_key=None,
+               mirror=None, index_registry=None, download_jobs=1,
+               extract_jobs=1, stream=False, keep_tarballs=False,
+               pkgs_dir=None, incremental=True, pkg_stores=()):
+    env = read_tag(repo, tag_name, target, mirror=mirror,
+                   incremental=incremental)
+    if env is not None:
+        create_env(api_user=api_user, api_key=api_key, mirror=mirror,
+                   index_registry=index_registry, download_jobs=download_jobs,
+                   extract_jobs=extract_jobs, stream=stream,
+                   keep_tarballs=keep_tarballs, pkgs_dir=pkgs_dir,
+                   pkg_stores=pkg_stores, **env)
+
+
+def lock_index(records, api_user=None, api_key=None, mirror=None):
+    """
+    Return the index of the packages of the given env.lock.json records,
+    ready for fetching and linking without any repodata.
+
+    """
+    index = {}
+    for record in records:
+        record = dict(record)
+        # Replace the channel URL with the mirror URL, as for the manifest.
+        # The package cache identifies packages by the channel they were
+        # downloaded from, so the dists must then be of the mirror's channel
+        # too, otherwise the fetch-extract may fail.
         if mirror is not None:
-            channels = [mirror]
-
-        if api_user and api_key:
-            # Inject the API user and key into the channel URLs...
-            for i, url in enumerate(channels):
-                parts = urlparse(url)
-                api_url = '{}://{}:{}@{}{}'.format(parts.scheme, api_user,
-                                                   api_key, parts.netloc,
-                                                   parts.path)
-                channels[i] = api_url
-            # Inject the API user and key into the manifest URLs...
-            for i, (url, _) in enumerate(pkgs):
-                parts = urlparse(url)
-                api_url = '{}://{}:{}@{}{}'.format(parts.scheme, api_user,
-                                                   api_key, parts.netloc,
-                                                   parts.path)
-                pkgs[i][0] = api_url
-
-        channels = prioritize_channels(channels)
-        # Build reverse look-up from channel URL to channel name.
-        channel_by_url = {url: channel
-                          for url, (channel, _) in channels.items()}
-        index = fetch_index(channels, use_cache=False)
-        resolver = Resolve(index)
-        # Create the package distribution from the manifest. Ensure to replace
-        # channel-URLs with channel names, otherwise the fetch-extract may fail
-        dists = [Dist.from_string(pkg,
-                                  channel_override=channel_by_url.get(url,
-                                                                      url))
-                 for url, pkg in pkgs]
-        # Use the resolver to sort packages into the appropriate dependency
-        # order.
-        sorted_dists = resolver.dependency_sort({dist.name: dist
-                                                 for dist in dists})
-
-        pfe = ProgressiveFetchExtract(index, sorted_dists)
+            record['channel'] = os.path.join(mirror, record['subdir'])
+            record['url'] = os.path.join(record['channel'], record['fn'])
+            record['schannel'] = Channel(mirror).canonical_name
+        for field in ['channel', 'url']:
+            if field in record:
+                record[field], = inject_credentials([record[field]],
+                                                    api_user, api_key)
+        dist = Dist.from_string(dist_name(record['fn']),
+                                channel_override=record['schannel'])
+        index[dist] = IndexRecord(**{field: value
+                                     for field, value in record.items()
+                                     if field in IndexRecord.__fields__})
+    return index
+
+
+def manifest_index(index, dists):
+    """
+    Return the records of the given index for only the given dists, raising
+    a ValueError if any of them are unavailable.
+
+    """
+    missing = [dist for dist in dists if dist not in index]
+    if missing:
+        msg = 'The following manifested packages are not available: {}'
+        raise ValueError(msg.format(', '.join(str(dist) for dist in missing)))
+    return {dist: index[dist] for dist in dists}
+
+
+def dependency_sort(index):
+    """
+    Return the dists of the given index sorted such that each package comes
+    after its dependencies, using only the ``depends`` of each record.
+
+    Unlike ``Resolve.dependency_sort``, this doesn't need the full channel
+    index, as a manifest already pins every package exactly. Dependency
+    cycles are broken by package name.
+
+    """
+    dist_by_name = {index[dist]['name']: dist for dist in index}
+    dependencies = {}
+    for name, dist in dist_by_name.items():
+        depends = set(spec.split()[0]
+                      for spec in index[dist].get('depends', ()))
+        dependencies[name] = (depends & set(dist_by_name)) - {name}
+
+    sorted_dists = []
+    while dependencies:
+        ready = sorted(name for name, depends in dependencies.items()
+                       if not depends)
+        if not ready:
+            ready = [min(dependencies)]
+        for name in ready:
+            del dependencies[name]
+            sorted_dists.append(dist_by_name[name])
+        for depends in dependencies.values():
+            depends.difference_update(ready)
+    return sorted_dists
+
+
+def fetch_manifest_index(spec, pkgs, api_user=None, api_key=None,
+                         mirror=None, index_registry=None):
+    """
+    Return the index of the packages of the given manifest, looked up in
+    the repodata of the spec's channels.
+
+    """
+    channels = spec.get('channels', [])
+
+    # Replace the channel/s specified in the environment specification
+    # with the mirror URL.
+    if mirror is not None:
+        channels = [mirror]
+
+    # Inject the API user and key into the channel and manifest URLs.
+    channels = inject_credentials(channels, api_user, api_key)
+    urls = inject_credentials([url for url, _ in pkgs], api_user, api_key)
+    pkgs = [[url, pkg] for url, (_, pkg) in zip(urls, pkgs)]
+
+    channel_map = prioritize_channels(channels)
+    # Build reverse look-up from channel URL to channel name.
+    channel_by_url = {url: channel
+                      for url, (channel, _) in channel_map.items()}
+    if index_registry is None:
+        index = fetch_index(channel_map, use_cache=False)
+    else:
+        index = index_registry.get_index(channels)
+    # Create the package distribution from the manifest. Ensure to replace
+    # channel-URLs with channel names, otherwise the fetch-extract may fail
+    dists = [Dist.from_string(pkg,
+                              channel_override=channel_by_url.get(url, url))
+             for url, pkg in pkgs]
+    # Only the manifested packages are needed from here on, so there's no
+    # need to build a resolver over the full index to sort them into the
+    # appropriate dependency order.
+    return manifest_index(index, dists)
+
+
+def fetch_extract(index, dists, pkgs_dir, download_jobs=1, extract_jobs=1,
+                  stream=False, keep_tarballs=False):
+    """
+    Ensure that the packages of the given dists are extracted in the
+    package cache directory, ready for linking.
+
+    """
+    # Conda keeps its own view of the package cache, which may be out of
+    # date if another process has since added to it.
+    PackageCache._cache_.pop(pkgs_dir, None)
+
+    # Conda can only fetch and extract packages in the .tar.bz2 format.
+    conda_format = any(index[dist]['fn'].endswith('.conda')
+                       for dist in dists)
+    if stream:
+        # Extract the packages as they are downloaded.
+        stream_packages(index, dists, pkgs_dir, jobs=download_jobs,
+                        keep_tarballs=keep_tarballs)
+        extracted = True
+    else:
+        if download_jobs > 1 or extract_jobs > 1 or conda_format:
+            # Download the packages concurrently into the package cache,
+            # such that conda only has to extract and link them.
+            download_packages(index, dists, pkgs_dir, jobs=download_jobs)
+        extracted = extract_jobs > 1 or conda_format
+        if extracted:
+            # Extract the packages across processes.
+            extract_packages(index, dists, pkgs_dir, jobs=extract_jobs)
+
+    if extracted:
+        # Conda only has to link the extracted packages, but must be made
+        # to look at the package cache again.
+        PackageCache._cache_.pop(pkgs_dir, None)
+    else:
+        pfe = ProgressiveFetchExtract(index, dists)
         pfe.execute()
-        mkdir_p(target)
-        txn = UnlinkLinkTransaction.create_from_dists(index, target, (),
-                                                      sorted_dists)
-        txn.execute()
-
 
-def _patch_pkgs_dirs(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        orig_pkgs_dirs = conda.base.context.Context.pkgs_dirs
 
-        if len(args) >= 2:
-            # Sniff the args to get the target deployment directory.
-            target = args[1]
-            # The associated target deployment custom package cache directory.
-            pkg_cache = os.path.join(target, PKG_CACHE_NAME)
+def env_index(spec, pkgs, records=None, api_user=None, api_key=None,
+              mirror=None, index_registry=None):
+    """
+    Return the index of the packages of an environment, from its
+    env.lock.json records if it has them, otherwise from the repodata of
+    the spec's channels.
+
+    """
+    if records is not None:
+        # The env.lock.json has everything needed, so there's no need
+        # to fetch any repodata.
+        return lock_index(records, api_user=api_user, api_key=api_key,
+                          mirror=mirror)
+    return fetch_manifest_index(spec, pkgs, api_user=api_user,
+                                api_key=api_key, mirror=mirror,
+                                index_registry=index_registry)
+
+
+def populate_pkgs_dir(index, dists, pkgs_dir, download_jobs=1,
+                      extract_jobs=1, stream=False, keep_tarballs=False,
+                      pkg_stores=()):
+    """
+    Ensure that the packages of the given dists are extracted in the
+    package cache directory, holding its lock throughout.
+
+    Packages in any of the given package stores are linked from there
+    rather than downloaded, and the others are added to them once
+    downloaded.
+
+    """
+    with Locked(pkgs_dir), package_cache(pkgs_dir):
+        fetch_from_stores(index, dists, pkgs_dir, pkg_stores)
+        fetch_extract(index, dists, pkgs_dir, download_jobs=download_jobs,
+                      extract_jobs=extract_jobs, stream=stream,
+                      keep_tarballs=keep_tarballs)
+        populate_stores(index, dists, pkgs_dir, pkg_stores)
+        mark_used(pkgs_dir, [dist.dist_name for dist in dists])
+
+
+def _create_env(env):
+    # Deploy a single environment. This is the unit of work handed to each
+    # process of the pool, so it must be a picklable top-level function.
+    index_registry = worker_state()
+    counts = index_registry.counts()
+    create_env(index_registry=index_registry, **env)
+    return env['target'], index_registry.take_counts(counts)
+
+
+def create_env(spec, pkgs, target, api_user=None, api_key=None, mirror=None,
+               index_registry=None, manifest_sha=None, records=None,
+               download_jobs=1, extract_jobs=1, stream=False,
+               keep_tarballs=False, pkgs_dir=None, base_prefix=None,
+               pkg_stores=(), fetch=True):
+    """
+    Deploy the environment of the given spec and manifested packages into
+    the target prefix, holding its lock.
+
+    Unless told not to fetch them (having already populated the package
+    cache, see :func:`populate_pkgs_dir`), the packages are first fetched
+    into the package cache.
+
+    """
+    if pkgs_dir is None:
+        pkgs_dir = conda.base.context.context.pkgs_dirs[0]
 
-            @property
-            def mocker(self):
-                return (pkg_cache,)
-
-            # Monkey patch the context pkgs_dirs property to override
-            # it with our custom package cache directory.
-            conda.base.context.Context.pkgs_dirs = mocker
+    with Locked(target):
+        index = env_index(spec, pkgs, records, api_user=api_user,
+                          api_key=api_key, mirror=mirror,
+                          index_registry=index_registry)
+        sorted_dists = dependency_sort(index)
+        with in_use(pkgs_dir, [dist.dist_name for dist in sorted_dists]):
+            if fetch:
+                populate_pkgs_dir(index, sorted_dists, pkgs_dir,
+                                  download_jobs=download_jobs,
+                                  extract_jobs=extract_jobs, stream=stream,
+                                  keep_tarballs=keep_tarballs,
+                                  pkg_stores=pkg_stores)
+            link_dists = sorted_dists
+            if base_prefix is not None:
+                link_dists = _clone_base(base_prefix, target, sorted_dists,
+                                         pkgs_dir)
+            mkdir_p(target)
+            with package_cache(pkgs_dir):
+                txn = UnlinkLinkTransaction.create_from_dists(
+                    index, target, (), link_dists)
+                txn.execute()
+
+        if manifest_sha is not None:
+            write_deployed_marker(target, manifest_sha,
+                                  sorted(pkg for _, pkg in pkgs))
+
+
+def _clone_base(base_prefix, target, dists, pkgs_dir):
+    # Clone the packages in common with the base prefix, returning the new
+    # (or changed) dists which are left to be linked. The base prefix is
+    # locked throughout, so that it can't be garbage collected part way
+    # through, and is checked to still be deployed.
+    with Locked(base_prefix):
+        if read_deployed_marker(base_prefix) is None:
+            print('{} is no longer deployed, so {} is deployed in full'
+                  ''.format(base_prefix, target))
+            return dists
+        cloned = clone_prefix(base_prefix, target,
+                              [dist.dist_name for dist in dists], pkgs_dir)
+    return [dist for dist in dists if dist.dist_name not in cloned]
+
+
+@contextlib.contextmanager
+def package_cache(pkgs_dir):
+    """
+    A context manager within which conda uses the given directory as its
+    (only) package cache.
+
+    conda 4.3 has no way of passing the package cache to the calls which
+    use it, so its context's pkgs_dirs property is patched for the duration,
+    and restored however the context is left.
+
+    """
+    orig_pkgs_dirs = conda.base.context.Context.pkgs_dirs
+
+    @property
+    def pkgs_dirs(self):
+        return (pkgs_dir,)
+
+    conda.base.context.Context.pkgs_dirs = pkgs_dirs
+    try:
+        yield
+    finally:
+        conda.base.context.Context.pkgs_dirs = orig_pkgs_dirs
 
-        result = func(*args, **kwargs)
 
-        # Undo the monkey patch of the context pkgs_dirs property.
-        conda.base.context.Context.pkgs_dirs = orig_pkgs_dirs
+def is_cached(pkgs_dir, dist_name):
+    """
+    Return whether the package of the given distribution name is in the
+    package cache directory, either extracted or as an archive.
 
-        return result
+    """
+    if is_extracted(os.path.join(pkgs_dir, dist_name)):
+        return True
+    return any(os.path.isfile(os.path.join(pkgs_dir, dist_name + extension))
+               for extension in PACKAGE_EXTENSIONS)
 
-    return wrapper
 
+def tags_by_env_label(repo, env_labels=None):
+    """
+    Return an ordered dictionary mapping the name of each of the repo's
+    environments to a dictionary of the tag of each of its labels,
+    including the "latest" label of its most recent tag. Only labels
+    matching one of the given "{environment}/{label}" patterns are
+    included.
 
-@_patch_pkgs_dirs
-def deploy_repo(repo, target, env_labels=None, api_user=None, api_key=None,
-                mirror=None):
-    env_tags = tags_by_env(repo)
+    """
+    refs = RefSnapshot(repo)
+    env_tags = tags_by_env(repo, refs)
+    if env_labels is None:
+        env_labels = ['*']
 
-    for branch in repo.branches:
+    labelled_tags_by_env = OrderedDict()
+    for branch in refs.branches.values():
         # We only want environment branches, not manifest branches.
         if not branch.name.startswith(manifest_branch_prefix):
             manifest_branch_name = manifest_branch_prefix + branch.name
             # If there is no equivalent manifest branch, we need to
             # skip this environment.
-            if manifest_branch_name not in repo.branches:
+            if manifest_branch_name not in refs.branches:
                 continue
-            branch.checkout()
-            all_labelled_tags = tags_by_label(os.path.join(repo.working_dir,
-                                                           'labels'))
+            commit = repo.commit(branch.commit_sha)
+            all_labelled_tags = tags_by_label_tree(commit)
 
             # Create a latest tag that points to the most recently tagged
             # environment.
             if env_tags.get(branch.name):
                 latest_tag = max(env_tags[branch.name],
-                                 key=lambda t: t.commit.committed_date)
+                                 key=lambda t: t.committed_date)
                 all_labelled_tags['latest'] = latest_tag.name
 
             # Only deploy environments that match the given pattern.
             labelled_tags = {}
-            if env_labels is None:
-                env_labels = ['*']
             for label, tag in all_labelled_tags.items():
                 item = '{}/{}'.format(branch.name, label)
                 match = [fnmatch(item, env_label)
                          for env_label in env_labels]
                 if any(match):
                     labelled_tags[label] = tag
+            labelled_tags_by_env[branch.name] = labelled_tags
+
+    return labelled_tags_by_env
+
+
+def plan_deploy(repo, target, env_labels=None, mirror=None,
+                incremental=True, pkg_stores=()):
+    """
+    Return the plan of the work needed to deploy the repo's labelled tags
+    into the target, without modifying the target. The plan is a
+    JSON serialisable dictionary of:
+
+     * deploy: the tags which need a new (or incomplete) prefix to be
+       deployed, with the arguments of :func:`create_env` to do so.
+     * reuse: the tags whose prefix is a symlink to a deployed prefix with
+       an identical manifest.
+     * labels: each label, with the deployed name it currently points to
+       and the one it is to point to.
+     * protected: the prefix (relative to the target) of every labelled
+       tag, regardless of the given environment labels, whose packages
+       are never evicted from the package cache.
+     * download: the packages which aren't yet in the package cache (or
+       any of the given package stores), and their total size (where
+       known from the env.lock.json).
+     * estimated_seconds: a rough estimate of the deployment time.
+
+    """
+    all_labelled_tags_by_env = tags_by_env_label(repo)
+    labelled_tags_by_env = all_labelled_tags_by_env
+    if env_labels is not None:
+        labelled_tags_by_env = tags_by_env_label(repo, env_labels)
+
+    # Read everything needed from the repo up front, such that the tags
+    # can then be deployed independently of one another. A tag with the
+    # same manifest content hash as another (e.g. only its env.spec
+    # changed) reuses that tag's prefix rather than being deployed again.
+    prefixes = deployed_prefixes(target)
+    deploy = []
+    reuse = []
+    for labelled_tags in labelled_tags_by_env.values():
+        for tag in sorted(set(labelled_tags.values())):
+            env = read_tag(repo, tag, target, mirror=mirror,
+                           incremental=incremental)
+            if env is None:
+                continue
+            prefix = prefixes.get(env['manifest_sha'])
+            if prefix is not None and not os.path.lexists(env['target']):
+                reuse.append(OrderedDict([('tag', tag), ('prefix', prefix),
+                                          ('target', env['target'])]))
+            else:
+                prefixes.setdefault(env['manifest_sha'], env['target'])
+                deploy.append(OrderedDict([('tag', tag), ('env', env)]))
+
+    labels = []
+    for env_name, labelled_tags in labelled_tags_by_env.items():
+        for label, tag in sorted(labelled_tags.items()):
+            location = os.path.join(target, env_name, label)
+            current = None
+            if os.path.islink(location):
+                current = os.readlink(location)
+            labels.append(OrderedDict([('env', env_name), ('label', label),
+                                       ('tag', tag), ('current', current),
+                                       ('target', tag.split('-', 2)[2])]))
+    # The labels of other environments, deployed by other runs, share the
+    # package cache just the same.
+    protected = sorted(set(
+        os.path.join(env_name, tag.split('-', 2)[2])
+        for env_name, labelled_tags in all_labelled_tags_by_env.items()
+        for tag in labelled_tags.values()))
+
+    # Work out which packages must be downloaded, and how many must be
+    # linked rather than cloned from the closest deployed prefix.
+    pkgs_dir = os.path.join(target, PKG_CACHE_NAME)
+    downloads = OrderedDict()
+    link_count = 0
+    for entry in deploy:
+        env = entry['env']
+        if env['records'] is not None:
+            sizes = [(dist_name(record['fn']), record.get('size'))
+                     for record in env['records']
+                     if not in_stores(pkg_stores, record)]
+        else:
+            # Without an env.lock.json the sizes are only in the repodata.
+            sizes = [(pkg, None) for _, pkg in env['pkgs']]
+        for name, size in sizes:
+            if name not in downloads and not is_cached(pkgs_dir, name):
+                downloads[name] = size
+        cloned = set()
+        if env['base_prefix'] is not None:
+            cloned = set(read_deployed_marker(env['base_prefix'])['packages'])
+        link_count += len([pkg for _, pkg in env['pkgs']
+                           if pkg not in cloned])
+    download_bytes = sum(size for size in downloads.values() if size)
+    estimate = (download_bytes / PLAN_DOWNLOAD_RATE +
+                link_count * PLAN_LINK_TIME)
+
+    return OrderedDict([
+        ('deploy', deploy),
+        ('reuse', reuse),
+        ('labels', labels),
+        ('protected', protected),
+        ('download', OrderedDict([
+            ('packages', sorted(downloads)),
+            ('bytes', download_bytes),
+            ('unknown_size', len([size for size in downloads.values()
+                                  if size is None]))])),
+        ('estimated_seconds', round(estimate, 1))])
+
+
+def plan_json(plan):
+    """
+    Return the given deploy plan as JSON, summarising each of the tags to
+    be deployed rather than including the full arguments of its
+    deployment.
+
+    """
+    summary = OrderedDict(plan)
+    summary['deploy'] = [
+        OrderedDict([('tag', entry['tag']),
+                     ('target', entry['env']['target']),
+                     ('manifest_sha', entry['env']['manifest_sha']),
+                     ('base_prefix', entry['env']['base_prefix']),
+                     ('packages', len(entry['env']['pkgs']))])
+        for entry in plan['deploy']]
+    return json.dumps(summary, indent=2)
+
+
+def execute_plan(plan, target, api_user=None, api_key=None, mirror=None,
+                 index_registry=None, download_jobs=1, extract_jobs=1,
+                 stream=False, keep_tarballs=False, jobs=1,
+                 max_cache_size=None, evict_tarballs_only=False,
+                 pkg_stores=()):
+    """
+    Carry out the given plan (see :func:`plan_deploy`) of deploying into
+    the target, sharing packages through the given package stores (see
+    :mod:`conda_gitenv.pkg_store`).
+
+    If given a maximum size (in bytes), the package cache is then cut down
+    to it (see :func:`conda_gitenv.pkg_cache.evict_packages`), without
+    evicting the packages of any labelled tag, including those of labels
+    which weren't planned to be deployed.
+
+    """
+    if index_registry is None:
+        index_registry = IndexRegistry()
+    pkgs_dir = os.path.join(target, PKG_CACHE_NAME)
+
+    # Populate the package cache with the packages of all of the tags up
+    # front, such that it is only locked once (with the downloads and
+    # extractions of every tag shared between them), and the tags can then
+    # be linked in parallel without contending for it. Until linked, the
+    # packages are marked as in use, so that they aren't evicted by another
+    # deployment in the meantime.
+    index = {}
+    for entry in plan['deploy']:
+        env = entry['env']
+        index.update(env_index(env['spec'], env['pkgs'], env['records'],
+                               api_user=api_user, api_key=api_key,
+                               mirror=mirror, index_registry=index_registry))
+    with in_use(pkgs_dir, [dist.dist_name for dist in index]):
+        if index:
+            populate_pkgs_dir(index, list(index), pkgs_dir,
+                              download_jobs=download_jobs,
+                              extract_jobs=extract_jobs, stream=stream,
+                              keep_tarballs=keep_tarballs,
+                              pkg_stores=pkg_stores)
+
+        envs = []
+        for entry in plan['deploy']:
+            env = dict(entry['env'])
+            env.update(api_user=api_user, api_key=api_key, mirror=mirror,
+                       pkgs_dir=pkgs_dir, fetch=False)
+            envs.append(env)
+
+        # Link the tags in a pool of processes, such that each process has its
+        # own conda state. The package cache is shared between them.
+        with pool_imap(_create_env, envs, jobs=jobs,
+                       state=index_registry) as results:
+            for _, counts in results:
+                index_registry.add_counts(counts)
+    for entry in plan['reuse']:
+        reuse_prefix(entry['prefix'], entry['target'])
+
+    # Lock down the package cache files which may contain
+    # API credentials.
+    mode = stat.S_IRUSR | stat.S_IWUSR
+    pkg_cache_urls = os.path.join(target, PKG_CACHE_NAME, 'urls.txt')
+    if os.path.isfile(pkg_cache_urls):
+        os.chmod(pkg_cache_urls, mode)
+
+    pkg_cache_urls = os.path.splitext(pkg_cache_urls)[0]
+    if os.path.isfile(pkg_cache_urls):
+        os.chmod(pkg_cache_urls, mode)
+
+    mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
+    for entry in plan['labels']:
+        label_location = os.path.join(target, entry['env'], entry['label'])
+        if entry['current'] != entry['target']:
+            msg = 'Linking {}/{} to {} ({})'
+            print(msg.format(entry['env'], entry['label'], entry['target'],
+                             entry['tag']))
+            replace_symlink(entry['target'], label_location)
+
+        # Lock down the conda-meta directory, which may contain
+        # API credentials.
+        conda_meta = os.path.join(target, entry['env'], entry['target'],
+                                  'conda-meta')
+        if os.path.isdir(conda_meta):
+            os.chmod(conda_meta, mode)
+
+    if max_cache_size is not None:
+        protected = set()
+        for prefix in plan['protected']:
+            protected.update(deployed_packages(os.path.join(target, prefix)))
+        with Locked(pkgs_dir):
+            evict_packages(pkgs_dir, max_cache_size, protected=protected,
+                           tarballs_only=evict_tarballs_only)
 
-            for tag in set(labelled_tags.values()):
-                deploy_tag(repo, tag, target,
-                           api_user=api_user, api_key=api_key, mirror=mirror)
-
-            # Lock down the package cache files which may contain
-            # API credentials.
-            mode = stat.S_IRUSR | stat.S_IWUSR
-            pkg_cache_urls = os.path.join(target, PKG_CACHE_NAME, 'urls.txt')
-            if os.path.isfile(pkg_cache_urls):
-                os.chmod(pkg_cache_urls, mode)
-
-            pkg_cache_urls = os.path.splitext(pkg_cache_urls)[0]
-            if os.path.isfile(pkg_cache_urls):
-                os.chmod(pkg_cache_urls, mode)
-
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
-            for label, tag in labelled_tags.items():
-                with Locked(os.path.join(target, label)):
-                    deployed_name = tag.split('-', 2)[2]
-                    label_target = deployed_name
-                    label_location = os.path.join(target, branch.name, label)
-
-                    if os.path.exists(label_location):
-                        if os.readlink(label_location) != label_target:
-                            os.remove(label_location)
-                   
-                    if not os.path.exists(label_location):
-                        msg = 'Linking {}/{} to {} ({})'
-                        print(msg.format(branch.name, label,
-                                         label_target, tag))
-                        os.symlink(label_target, label_location)
-
-                    # Lock down the conda-meta directory, which may contain
-                    # API credentials.
-                    conda_meta = os.path.join(target, branch.name,
-                                              label_target, 'conda-meta')
-                    if os.path.isdir(conda_meta):
-                        os.chmod(conda_meta, mode)
+
+def deploy_repo(repo, target, env_labels=None, api_user=None, api_key=None,
+                mirror=None, index_registry=None, download_jobs=1,
+                extract_jobs=1, stream=False, keep_tarballs=False, jobs=1,
+                incremental=True, max_cache_size=None,
+                evict_tarballs_only=False, pkg_stores=()):
+    plan = plan_deploy(repo, target, env_labels=env_labels, mirror=mirror,
+                       incremental=incremental, pkg_stores=pkg_stores)
+    execute_plan(plan, target, api_user=api_user, api_key=api_key,
+                 mirror=mirror, index_registry=index_registry,
+                 download_jobs=download_jobs, extract_jobs=extract_jobs,
+                 stream=stream, keep_tarballs=keep_tarballs, jobs=jobs,
+                 max_cache_size=max_cache_size,
+                 evict_tarballs_only=evict_tarballs_only,
+                 pkg_stores=pkg_stores)
 
 
 def configure_parser(parser):
@@ -250,15 +848,62 @@ def configure_parser(parser):
                              'form "{environment}/{label}".', )
     parser.add_argument('--mirror', '-m', action='store',
                         help='the replacement mirror channel URL')
+    parser.add_argument('--index-cache-dir', action='store',
+                        help='the directory in which to persist channel '
+                             'repodata between runs')
+    parser.add_argument('--max-index-age', type=int, default=None,
+                        help='the age (in seconds) within which cached '
+                             'repodata is used without revalidation')
+    parser.add_argument('--cache-dir', action='store',
+                        help='the directory in which to keep a mirror of '
+                             'the repo between runs')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=1,
+                        help='the number of environments to deploy '
+                             'concurrently')
+    parser.add_argument('--no-incremental', dest='incremental',
+                        action='store_false',
+                        help='link every package of a new environment, '
+                             'rather than cloning those in common with '
+                             'the closest deployed tag')
+    parser.add_argument('--download-jobs', type=positive_int, default=1,
+                        help='the number of packages to download '
+                             'concurrently')
+    parser.add_argument('--extract-jobs', type=positive_int, default=1,
+                        help='the number of processes with which to extract '
+                             'downloaded packages')
+    parser.add_argument('--stream', action='store_true',
+                        help='extract packages as they are downloaded, '
+                             'rather than once fully downloaded')
+    parser.add_argument('--keep-tarballs', action='store_true',
+                        help='keep the package tarballs in the package '
+                             'cache when streaming')
+    parser.add_argument('--max-cache-size', type=float, default=None,
+                        help='the size (in MB) to cut the package cache '
+                             'down to after deploying, evicting the least '
+                             'recently used packages not needed by a '
+                             'labelled tag')
+    parser.add_argument('--evict-tarballs-only', action='store_true',
+                        help='only evict the tarballs of extracted packages '
+                             'from the package cache')
+    parser.add_argument('--pkg-store', dest='pkg_stores', action='append',
+                        default=[],
+                        help='a package store, shared between deployment '
+                             'targets, to link packages from and add '
+                             'downloaded packages to. May be given more '
+                             'than once, in order of preference')
+    parser.add_argument('--plan', action='store_true',
+                        help='print (as JSON) the work needed to deploy, '
+                             'without modifying the target')
     parser.set_defaults(function=handle_args)
     return parser
 
 
 def handle_args(args):
-    with tempdir() as repo_directory:
-        repo = Repo.clone_from(args.repo_uri, repo_directory)
-        create_tracking_branches(repo)
-
+    # All branches (for their labels) and tags are needed, but only the
+    # blobs of the labelled tags, which a partial clone fetches on demand.
+    refspecs = ['+refs/heads/*:refs/remotes/origin/*',
+                '+refs/tags/*:refs/tags/*']
+    with cloned_repo(args.repo_uri, args.cache_dir, refspecs) as repo:
         mirror = args.mirror
         if mirror is not None and os.path.isdir(mirror):
             # For convenience, add the "file" scheme to a raw directory
@@ -266,9 +911,26 @@ def handle_args(args):
             mirror = os.path.abspath(os.path.expanduser(mirror))
             mirror = "file:/{}".format(os.path.normpath(mirror))
 
-        deploy_repo(repo, args.target, env_labels=args.env_labels,
-                    api_user=args.api_user, api_key=args.api_key,
-                    mirror=mirror)
+        plan = plan_deploy(repo, args.target, env_labels=args.env_labels,
+                           mirror=mirror, incremental=args.incremental,
+                           pkg_stores=args.pkg_stores)
+        if args.plan:
+            print(plan_json(plan))
+            return
+        index_registry = IndexRegistry(cache_dir=args.index_cache_dir,
+                                       max_age=args.max_index_age)
+        max_cache_size = None
+        if args.max_cache_size is not None:
+            max_cache_size = int(args.max_cache_size * 1e6)
+        execute_plan(plan, args.target, api_user=args.api_user,
+                     api_key=args.api_key, mirror=mirror,
+                     index_registry=index_registry,
+                     download_jobs=args.download_jobs,
+                     extract_jobs=args.extract_jobs, stream=args.stream,
+                     keep_tarballs=args.keep_tarballs, jobs=args.jobs,
+                     max_cache_size=max_cache_size,
+                     evict_tarballs_only=args.evict_tarballs_only,
+                     pkg_stores=args.pkg_stores)
 
 
 def main():
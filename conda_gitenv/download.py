@@ -0,0 +1,253 @@
+from __future__ import division, print_function
+
+import hashlib
+import os
+import shutil
+import tarfile
+import time
+
+from conda.connection import CondaSession
+from conda.gateways.disk.create import mkdir_p
+
+from conda_gitenv.extract import (extract_package, extracted_dir,
+                                  is_extracted, legacy_url, move_into_place)
+from conda_gitenv.pool import pool_imap
+
+
+#: The size of the chunks in which packages are streamed to disk.
+CHUNK_SIZE = 1 << 16
+
+
+def file_md5(path):
+    """
+    Return the MD5 hex digest of the file at the given path.
+
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_package(url, path, md5=None):
+    """
+    Download the package at the given URL to the given path, verifying its
+    MD5 (if given) as it is streamed to disk. Return the number of bytes
+    downloaded.
+
+    The package is only moved into place once verified, so a failed or
+    interrupted download never leaves a corrupt package at the path.
+
+    """
+    response = CondaSession().get(url, stream=True)
+    response.raise_for_status()
+    digest = hashlib.md5()
+    size = 0
+    partial = path + '.partial'
+    try:
+        with open(partial, 'wb') as fh:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                digest.update(chunk)
+                fh.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        # Including interrupts, so nothing is left behind.
+        os.remove(partial)
+        raise
+    if md5 is not None and digest.hexdigest() != md5:
+        os.remove(partial)
+        msg = 'MD5 mismatch for {}: expected {}, got {}.'
+        raise ValueError(msg.format(url, md5, digest.hexdigest()))
+    os.rename(partial, path)
+    return size
+
+
+class StreamReader(object):
+    def __init__(self, chunks, tarball=None):
+        """
+        A read-only file object over the given iterable of byte chunks,
+        which computes the MD5 of (and optionally writes to the given open
+        tarball) the bytes as they are read.
+
+        """
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._tarball = tarball
+        #: The MD5 of the bytes read so far.
+        self.md5 = hashlib.md5()
+        #: The number of bytes read so far.
+        self.size = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.md5.update(chunk)
+            self.size += len(chunk)
+            if self._tarball is not None:
+                self._tarball.write(chunk)
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def stream_package(url, pkgs_dir, fn, md5=None, keep_tarball=False):
+    """
+    Download and extract the package at the given URL into the package
+    cache directory in a single pass, such that it is unpacked as the bytes
+    arrive rather than once fully downloaded. The MD5 (if given) is
+    verified on the fly. Return the number of bytes downloaded.
+
+    The tarball is only kept in the package cache if asked for. Whatever
+    the format, the package is extracted under a temporary name and
+    nothing is moved into place unless complete, with its MD5 verified.
+
+    """
+    destination = extracted_dir(pkgs_dir, fn)
+    if fn.endswith('.conda'):
+        # A .conda package is a zip, which can't be read until complete.
+        # Its payload is quick to extract regardless, and extract_package
+        # stages it just as below.
+        archive = os.path.join(pkgs_dir, fn)
+        size = download_package(url, archive, md5)
+        try:
+            extract_package(archive, destination)
+        finally:
+            if not keep_tarball:
+                os.remove(archive)
+        return size
+
+    partial_dir = destination + '.partial'
+    partial_tarball = os.path.join(pkgs_dir, fn + '.partial')
+    if os.path.lexists(partial_dir):
+        shutil.rmtree(partial_dir)
+
+    response = CondaSession().get(url, stream=True)
+    response.raise_for_status()
+    tarball = open(partial_tarball, 'wb') if keep_tarball else None
+    try:
+        reader = StreamReader(response.iter_content(CHUNK_SIZE), tarball)
+        with tarfile.open(fileobj=reader, mode='r|bz2') as tar:
+            tar.extractall(partial_dir)
+        # Read to the very end, to include any trailing padding in the MD5.
+        while reader.read(CHUNK_SIZE):
+            pass
+    except BaseException:
+        # Including interrupts, so nothing is left behind.
+        if os.path.isdir(partial_dir):
+            shutil.rmtree(partial_dir)
+        if tarball is not None:
+            tarball.close()
+            os.remove(partial_tarball)
+        raise
+    finally:
+        if tarball is not None:
+            tarball.close()
+
+    if md5 is not None and reader.md5.hexdigest() != md5:
+        shutil.rmtree(partial_dir)
+        if keep_tarball:
+            os.remove(partial_tarball)
+        msg = 'MD5 mismatch for {}: expected {}, got {}.'
+        raise ValueError(msg.format(url, md5, reader.md5.hexdigest()))
+    move_into_place(partial_dir, destination)
+    if keep_tarball:
+        os.rename(partial_tarball, os.path.join(pkgs_dir, fn))
+    return reader.size
+
+
+def _download(task):
+    # The unit of work handed to each thread of the pool.
+    url, path, md5 = task
+    start = time.time()
+    size = download_package(url, path, md5)
+    return url, os.path.basename(path), size, time.time() - start
+
+
+def _stream(task):
+    # The unit of work handed to each thread of the pool when streaming.
+    url, pkgs_dir, fn, md5, keep_tarball = task
+    start = time.time()
+    size = stream_package(url, pkgs_dir, fn, md5, keep_tarball)
+    return url, fn, size, time.time() - start
+
+
+def throughput(size, seconds):
+    """
+    Return a human readable summary of transferring size bytes in the
+    given number of seconds.
+
+    """
+    megabytes = size / 1e6
+    rate = megabytes / seconds if seconds > 0 else float('inf')
+    return '{:.1f} MB in {:.1f}s, {:.1f} MB/s'.format(megabytes, seconds,
+                                                       rate)
+
+
+def download_packages(index, dists, pkgs_dir, jobs=1):
+    """
+    Download the packages of the given dists into the package cache
+    directory, using up to the given number of concurrent downloads.
+    Packages which are already in the cache (with the expected MD5, or
+    extracted) are not downloaded again.
+
+    The URL of each downloaded package is recorded in the cache's urls.txt,
+    as conda does, so that conda subsequently recognises the package as
+    cached rather than fetching it again.
+
+    """
+    mkdir_p(pkgs_dir)
+    tasks = []
+    for dist in dists:
+        record = index[dist]
+        path = os.path.join(pkgs_dir, record['fn'])
+        md5 = record.get('md5')
+        if os.path.isfile(path) and (md5 is None or file_md5(path) == md5):
+            continue
+        # The tarball may have been evicted from the cache, leaving only
+        # the extracted package.
+        if is_extracted(extracted_dir(pkgs_dir, record['fn'])):
+            continue
+        tasks.append((record.get('url') or dist.to_url(), path, md5))
+    _transfer(_download, tasks, pkgs_dir, jobs, 'Downloaded')
+
+
+def stream_packages(index, dists, pkgs_dir, jobs=1, keep_tarballs=False):
+    """
+    Download and extract the packages of the given dists into the package
+    cache directory in a single pass (see :func:`stream_package`), using up
+    to the given number of concurrent downloads. Packages which are already
+    extracted in the cache are not downloaded again.
+
+    """
+    mkdir_p(pkgs_dir)
+    tasks = []
+    for dist in dists:
+        record = index[dist]
+        if is_extracted(extracted_dir(pkgs_dir, record['fn'])):
+            continue
+        tasks.append((record.get('url') or dist.to_url(), pkgs_dir,
+                      record['fn'], record.get('md5'), keep_tarballs))
+    _transfer(_stream, tasks, pkgs_dir, jobs, 'Streamed')
+
+
+def _transfer(worker, tasks, pkgs_dir, jobs, verb):
+    # Run the given worker over the tasks in a pool of threads, reporting
+    # the throughput of each package and overall.
+    if not tasks:
+        return
+
+    start = time.time()
+    total_size = 0
+    with pool_imap(worker, tasks, jobs=jobs, threads=True) as results, \
+            open(os.path.join(pkgs_dir, 'urls.txt'), 'a') as urls:
+        for url, fn, size, seconds in results:
+            print('{} {} ({})'.format(verb, fn, throughput(size, seconds)))
+            urls.write(legacy_url(url) + '\n')
+            total_size += size
+    print('{} {} packages ({})'.format(
+        verb, len(tasks), throughput(total_size, time.time() - start)))
@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+import os
+import shutil
+import time
+
+from conda.gateways.disk.create import extract_tarball
+
+from conda_gitenv.pool import pool_imap
+
+
+#: The package archive formats, in order of preference.
+PACKAGE_EXTENSIONS = ('.conda', '.tar.bz2')
+
+
+def dist_name(fn):
+    """
+    Return the distribution name (e.g. "python-3.6.0-0") of the given
+    package archive filename, in any of the supported formats.
+
+    """
+    for extension in PACKAGE_EXTENSIONS:
+        if fn.endswith(extension):
+            return fn[:-len(extension)]
+    raise ValueError('Unknown package archive format of {}.'.format(fn))
+
+
+def legacy_url(url):
+    """
+    Return the given package URL as conda 4.3, which only knows of the
+    .tar.bz2 format, expects it to be in the package cache's urls.txt.
+
+    Conda identifies an extracted package by looking up the .tar.bz2 URL
+    of its directory name, whatever the format it was extracted from.
+
+    """
+    base, fn = url.rsplit('/', 1)
+    return '{}/{}.tar.bz2'.format(base, dist_name(fn))
+
+
+def extracted_dir(pkgs_dir, fn):
+    """
+    Return the directory of the package cache into which the package
+    archive of the given filename is extracted.
+
+    """
+    return os.path.join(pkgs_dir, dist_name(fn))
+
+
+def move_into_place(partial, destination):
+    """
+    Rename the given fully extracted package directory to the destination,
+    replacing whatever (e.g. an incomplete extraction) was there.
+
+    """
+    if os.path.lexists(destination):
+        shutil.rmtree(destination)
+    os.rename(partial, destination)
+
+
+def extract_package(archive, destination):
+    """
+    Extract the package archive, in any of the supported formats, into the
+    given directory.
+
+    The package is extracted under a temporary name alongside the
+    directory and only moved into place once complete, so an interrupted
+    extraction never leaves a package which looks extracted, or which gets
+    in the way of extracting it again.
+
+    """
+    partial = destination + '.partial'
+    if os.path.lexists(partial):
+        shutil.rmtree(partial)
+    try:
+        if archive.endswith('.conda'):
+            # Only needed for the .conda format, which conda itself doesn't
+            # (yet) know how to extract.
+            from conda_package_handling import api
+            api.extract(archive, dest_dir=partial)
+        else:
+            extract_tarball(archive, partial)
+    except BaseException:
+        # Including interrupts, so nothing is left behind.
+        if os.path.lexists(partial):
+            shutil.rmtree(partial)
+        raise
+    move_into_place(partial, destination)
+
+
+def is_extracted(path):
+    """
+    Return whether the given package cache directory holds a fully
+    extracted package.
+
+    """
+    return os.path.isfile(os.path.join(path, 'info', 'index.json'))
+
+
+def _extract(task):
+    # Extract a single package. This is the unit of work handed to each
+    # process of the pool, so it must be a picklable top-level function.
+    archive, destination = task
+    extract_package(archive, destination)
+    return archive
+
+
+def extract_packages(index, dists, pkgs_dir, jobs=1):
+    """
+    Extract the downloaded packages of the given dists in the package cache
+    directory, using a pool of up to the given number of processes.
+
+    Decompression is CPU bound, so unlike downloading it is spread across
+    processes rather than threads. Packages which are already extracted,
+    or which haven't been downloaded, are left for conda to deal with.
+
+    """
+    tasks = []
+    for dist in dists:
+        fn = index[dist]['fn']
+        archive = os.path.join(pkgs_dir, fn)
+        destination = extracted_dir(pkgs_dir, fn)
+        if os.path.isfile(archive) and not is_extracted(destination):
+            tasks.append((archive, destination))
+    if not tasks:
+        return
+
+    start = time.time()
+    with pool_imap(_extract, tasks, jobs=jobs) as results:
+        for archive in results:
+            print('Extracted {}'.format(os.path.basename(archive)))
+    print('Extracted {} packages in {:.1f}s'.format(len(tasks),
+                                                     time.time() - start))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+from functools import partial
+from glob import glob
+import os
+import shutil
+
+from conda_gitenv.deploy import (DEPLOYED_MARKER, tags_by_env,
+                                 tags_by_env_label)
+from conda_gitenv.lock import Locked
+from conda_gitenv.pool import pool_imap, positive_int
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.resolve import cloned_repo
+
+
+def _symlink_chain(path):
+    # Return the given path followed by each of the paths its symlinks
+    # resolve through, in turn.
+    chain = [path]
+    while os.path.islink(path):
+        path = os.path.normpath(os.path.join(os.path.dirname(path),
+                                             os.readlink(path)))
+        chain.append(path)
+    return chain
+
+
+def is_referenced(prefix, target, ignore=()):
+    """
+    Return whether any symlink under the target (e.g. a label, or a prefix
+    reusing another), other than those of the given paths to ignore,
+    resolves to (or through) the given prefix.
+
+    """
+    for path in glob(os.path.join(target, '*', '*')):
+        if path in ignore or not os.path.islink(path):
+            continue
+        if prefix in _symlink_chain(path)[1:]:
+            return True
+    return False
+
+
+def unreferenced_prefixes(repo, target, keep=0):
+    """
+    Return the deployed prefixes under the target which are no longer
+    needed, sorted by path.
+
+    A prefix is only a candidate for removal if it is named after one of
+    the repo's tags of its environment. It is needed if any label of the
+    repo points to its tag, or its tag is one of the given number of most
+    recent tags of its environment. Any symlink under the target which isn't
+    itself a candidate for removal (e.g. a label) also keeps the prefix it
+    resolves to, as does a needed prefix which reuses another (i.e. is a
+    symlink to it).
+
+    """
+    target = os.path.abspath(target)
+    refs = RefSnapshot(repo)
+    env_tags = tags_by_env(repo, refs)
+    labelled = tags_by_env_label(repo)
+
+    candidates = set()
+    needed = set()
+    for env_name, tags in env_tags.items():
+        env_dir = os.path.join(target, env_name)
+        if not os.path.isdir(env_dir):
+            continue
+        tags = sorted(tags, key=lambda tag: tag.committed_date, reverse=True)
+        names = set(tag.name.split('-', 2)[2] for tag in tags)
+        keep_tags = [tag.name for tag in tags[:keep]]
+        keep_tags.extend(labelled.get(env_name, {}).values())
+        keep_names = set(tag.split('-', 2)[2] for tag in keep_tags)
+        for name in os.listdir(env_dir):
+            path = os.path.join(env_dir, name)
+            if name in names:
+                if name in keep_names:
+                    needed.add(path)
+                else:
+                    candidates.add(path)
+            elif os.path.islink(path):
+                needed.add(path)
+
+    # Follow the symlinks (labels, and reused prefixes) to the prefixes
+    # they point to, which must be kept.
+    kept = set()
+    for path in needed:
+        kept.update(_symlink_chain(path))
+    return sorted(candidates - kept)
+
+
+def reclaimable_bytes(prefixes):
+    """
+    Return the number of bytes which removing the given prefixes would free
+    up. Files hardlinked from elsewhere (e.g. the package cache, or another
+    prefix) are only counted if all of their links are being removed.
+
+    """
+    inodes = {}
+    for prefix in prefixes:
+        if os.path.islink(prefix):
+            continue
+        for dirpath, dirnames, filenames in os.walk(prefix):
+            for name in filenames:
+                stat = os.lstat(os.path.join(dirpath, name))
+                key = (stat.st_dev, stat.st_ino)
+                size, nlink, seen = inodes.get(key, (stat.st_size,
+                                                     stat.st_nlink, 0))
+                inodes[key] = (size, nlink, seen + 1)
+    return sum(size for size, nlink, seen in inodes.values()
+               if seen >= nlink)
+
+
+def remove_prefix(prefix, target=None, removing=()):
+    """
+    Remove the given deployed prefix, holding its lock. Return the prefix,
+    or None if it was kept.
+
+    Given the target it was deployed under, the prefix is kept if any
+    symlink under the target, other than those of the given prefixes also
+    being removed, has since come to resolve to it (e.g. a deployment has
+    reused it, which it does holding the same lock).
+
+    """
+    with Locked(prefix):
+        if target is not None and is_referenced(prefix, target, removing):
+            print('Keeping {}, which is now in use'.format(prefix))
+            return None
+        if os.path.islink(prefix):
+            os.remove(prefix)
+        else:
+            # Remove the deployed marker first, such that a partially
+            # removed prefix is seen as incomplete rather than deployed.
+            marker = os.path.join(prefix, DEPLOYED_MARKER)
+            if os.path.exists(marker):
+                os.remove(marker)
+            shutil.rmtree(prefix)
+    return prefix
+
+
+def gc_repo(repo, target, keep=0, jobs=1, dry_run=False):
+    """
+    Remove the deployed prefixes under the target which are no longer
+    needed (see :func:`unreferenced_prefixes`), using up to the given
+    number of concurrent removals. Return the prefixes and the number of
+    bytes reclaimed (or which would be, for a dry run).
+
+    """
+    target = os.path.abspath(target)
+    prefixes = unreferenced_prefixes(repo, target, keep=keep)
+    size = reclaimable_bytes(prefixes)
+    if dry_run:
+        for prefix in prefixes:
+            print('Would remove {}'.format(prefix))
+        print('{} prefixes, {:.1f} MB reclaimable'.format(len(prefixes),
+                                                          size / 1e6))
+        return prefixes, size
+
+    # The prefixes are checked again as they are removed, as deployments
+    # may have reused them in the meantime.
+    # Removal is I/O bound, so threads suffice.
+    remove = partial(remove_prefix, target=target, removing=set(prefixes))
+    removed = []
+    with pool_imap(remove, prefixes, jobs=jobs, threads=True) as results:
+        for prefix in results:
+            if prefix is not None:
+                print('Removed {}'.format(prefix))
+                removed.append(prefix)
+    if len(removed) < len(prefixes):
+        size -= reclaimable_bytes(sorted(set(prefixes) - set(removed)))
+    print('{} prefixes, {:.1f} MB reclaimed'.format(len(removed),
+                                                    size / 1e6))
+    return sorted(removed), size
+
+
+def configure_parser(parser):
+    parser.add_argument('repo_uri', help='Repo of the deployed environments.')
+    parser.add_argument('target', help='Location of the deployed '
+                                       'environments.')
+    parser.add_argument('--keep', type=int, default=0,
+                        help='the number of most recent tags of each '
+                             'environment to keep, whether labelled or not')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=1,
+                        help='the number of prefixes to remove '
+                             'concurrently')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would be removed, and the space '
+                             'reclaimed, without removing anything')
+    parser.add_argument('--cache-dir', action='store',
+                        help='the directory in which to keep a mirror of '
+                             'the repo between runs')
+    parser.set_defaults(function=handle_args)
+    return parser
+
+
+def handle_args(args):
+    # All branches (for their labels) and tags are needed.
+    refspecs = ['+refs/heads/*:refs/remotes/origin/*',
+                '+refs/tags/*:refs/tags/*']
+    with cloned_repo(args.repo_uri, args.cache_dir, refspecs) as repo:
+        gc_repo(repo, args.target, keep=args.keep, jobs=args.jobs,
+                dry_run=args.dry_run)
+
+
+def main():
+    import argparse
+
+    description = 'Remove deployed environments which are no longer needed.'
+    parser = argparse.ArgumentParser(description=description)
+    configure_parser(parser)
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+from __future__ import print_function
+
+import hashlib
+import os
+import time
+
+from conda.connection import CondaSession
+from conda.core.repodata import (cache_fn_url, fetch_repodata,
+                                 read_local_repodata, read_mod_and_etag)
+from conda.gateways.disk.create import mkdir_p
+from conda.models.channel import prioritize_channels
+from conda.models.dist import Dist
+from conda.models.index_record import IndexRecord
+
+from conda_gitenv.extract import dist_name
+
+
+def fetch_subdir_index(url, schannel, priority, cache_dir=None,
+                       max_age=None):
+    """
+    Return the index of a single channel/subdir.
+
+    If a cache directory is given, the repodata is persisted there, and
+    subsequent fetches revalidate it with a conditional request (using the
+    ETag and Last-Modified headers of the cached response). Cached repodata
+    which is younger than ``max_age`` seconds is used without revalidation.
+
+    Where the channel offers a package in both the .tar.bz2 and .conda
+    formats, the record of the .conda package is returned.
+
+    """
+    if cache_dir is not None:
+        mkdir_p(cache_dir)
+        cache_path = os.path.join(cache_dir, cache_fn_url(url))
+        if max_age is not None and os.path.exists(cache_path):
+            age = time.time() - os.path.getmtime(cache_path)
+            if age < max_age:
+                headers = read_mod_and_etag(cache_path)
+                repodata = read_local_repodata(cache_path, url, schannel,
+                                               priority,
+                                               headers.get('_etag'),
+                                               headers.get('_mod'))
+                return subdir_packages(repodata, url, schannel, priority)
+
+    # Without a cache directory, conda's own cache directory is used (just
+    # as conda's fetch_index does).
+    repodata = fetch_repodata(url, schannel, priority, cache_dir=cache_dir,
+                              use_cache=False, session=CondaSession())
+    if repodata is None:
+        # The channel doesn't provide this subdir.
+        return {}
+    return subdir_packages(repodata, url, schannel, priority)
+
+
+def subdir_packages(repodata, url, schannel, priority):
+    """
+    Return the package records of the given channel/subdir repodata,
+    preferring the .conda format over .tar.bz2 where both are available.
+
+    Conda 4.3 only turns the "packages" (i.e. .tar.bz2) of the repodata
+    into records, so the "packages.conda" are turned into records here.
+
+    """
+    packages = dict(repodata.get('packages', {}))
+    for fn, info in repodata.get('packages.conda', {}).items():
+        info = dict(info, fn=fn, url='{}/{}'.format(url.rstrip('/'), fn),
+                    channel=url, schannel=schannel, priority=priority)
+        dist = Dist.from_string(dist_name(fn), channel_override=schannel)
+        packages[dist] = IndexRecord(**info)
+    return packages
+
+
+def index_fingerprint(index):
+    """
+    Return a digest of the package records of the given index, which changes
+    whenever a package is added, removed or has its metadata patched.
+
+    """
+    fingerprint = hashlib.sha1()
+    for info in sorted(index.values(), key=lambda info: info['fn']):
+        entry = '{}\t{}\t{}\n'.format(info['fn'], info.get('md5', ''),
+                                      ','.join(info.get('depends', ())))
+        fingerprint.update(entry.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class IndexRegistry(object):
+    def __init__(self, cache_dir=None, max_age=None):
+        """
+        A registry of channel indices which lives for the duration of a
+        single run, such that the repodata of each channel/subdir is only
+        fetched and parsed once, no matter how many environments use it.
+
+        The cache_dir and max_age are passed through to
+        :func:`fetch_subdir_index` to persist repodata between runs.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        # The index of each channel/subdir, keyed by (url, schannel, priority).
+        self._subdir_indices = {}
+        # The combined index of each normalised channel list.
+        self._indices = {}
+        # The fingerprint of each channel/subdir, with the same keys as above.
+        self._subdir_fingerprints = {}
+        #: The number of channel/subdir lookups served from the registry.
+        self.hits = 0
+        #: The number of channel/subdir lookups which had to be fetched.
+        self.misses = 0
+
+    def get_index(self, channels):
+        """
+        Return the index of packages available on the given channels,
+        equivalent to ``conda.api.get_index(channels, prepend=False)``.
+
+        The channel URLs should already have any API credentials injected.
+        The same index instance is returned for equivalent channel lists.
+
+        """
+        channel_map = prioritize_channels(channels)
+        key = tuple(channel_map.items())
+        index = self._indices.get(key)
+        if index is None:
+            index = {}
+            for url, (schannel, priority) in channel_map.items():
+                index.update(self._subdir_index(url, schannel, priority))
+            self._indices[key] = index
+        else:
+            self.hits += len(channel_map)
+        return index
+
+    def _subdir_index(self, url, schannel, priority):
+        key = (url, schannel, priority)
+        index = self._subdir_indices.get(key)
+        if index is None:
+            self.misses += 1
+            index = fetch_subdir_index(url, schannel, priority,
+                                       cache_dir=self.cache_dir,
+                                       max_age=self.max_age)
+            self._subdir_indices[key] = index
+        else:
+            self.hits += 1
+        return index
+
+    def fingerprint(self, channels):
+        """
+        Return a digest of the repodata snapshot used for the given channels.
+
+        """
+        channel_map = prioritize_channels(channels)
+        fingerprint = hashlib.sha1()
+        for url, (schannel, priority) in channel_map.items():
+            key = (url, schannel, priority)
+            if key not in self._subdir_fingerprints:
+                index = self._subdir_index(url, schannel, priority)
+                self._subdir_fingerprints[key] = index_fingerprint(index)
+            entry = '{}\t{}\t{}\n'.format(schannel, priority,
+                                          self._subdir_fingerprints[key])
+            fingerprint.update(entry.encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def counts(self):
+        """
+        Return the number of (hits, misses) so far.
+
+        """
+        return self.hits, self.misses
+
+    def take_counts(self, since):
+        """
+        Return the number of (hits, misses) since the given :meth:`counts`,
+        taking them off this registry so that they can be handed to another
+        with :meth:`add_counts`.
+
+        This is how a pool worker reports the lookups made by its copy of
+        the registry, without them being counted twice when the tasks are
+        run serially on the registry itself.
+
+        """
+        hits, misses = self.hits - since[0], self.misses - since[1]
+        self.hits, self.misses = since
+        return hits, misses
+
+    def add_counts(self, counts):
+        hits, misses = counts
+        self.hits += hits
+        self.misses += misses
+
+    def summary(self):
+        return 'Channel index hits: {}, misses: {}'.format(self.hits,
+                                                           self.misses)
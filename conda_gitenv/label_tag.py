@@ -6,17 +6,20 @@ import os
 import shutil
 import time
 
-from git import Repo
-from conda_gitenv.resolve import tempdir, create_tracking_branches
+from git import Head
+
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.resolve import cloned_repo, push_refs
 
 
 def progress_label(repo, next_tag, next_only=False):
     # Pull out the environment name from the form "env_<env_name>_2000_12_25".
     environment_name = next_tag.split('-')[1]
-    env_branch = repo.branches[environment_name]
+    refs = RefSnapshot(repo)
+    env_branch = Head(repo, refs.branches[environment_name].path)
     env_branch.checkout()
     
-    if not next_tag in repo.tags:
+    if not next_tag in refs.tags:
         raise RuntimeError('No tag {!r} exists in the repo.'.format(next_tag))
 
     labels_dir = os.path.join(repo.working_dir, 'labels')
@@ -57,16 +60,22 @@ def configure_parser(parser):
     parser.add_argument('repo_uri', help='The repo to push the labels to.')
     parser.add_argument('next_tag', help='The tag to use for "next". The environment is deduced from that in the tag name.')
     parser.add_argument('--next-only', help='Whether to only update "next" and not current & previous.', action='store_true')
+    parser.add_argument('--cache-dir', action='store',
+                        help='the directory in which to keep a mirror of '
+                             'the repo between runs')
     parser.set_defaults(function=handle_args)
     return parser
 
 
 def handle_args(args):
-    with tempdir() as repo_directory:
-        repo = Repo.clone_from(args.repo_uri, repo_directory)
-        create_tracking_branches(repo)
+    # Only the environment's branch and the tags are needed.
+    environment_name = args.next_tag.split('-')[1]
+    refspecs = ['+refs/heads/{0}:refs/remotes/origin/{0}'
+                ''.format(environment_name),
+                '+refs/tags/*:refs/tags/*']
+    with cloned_repo(args.repo_uri, args.cache_dir, refspecs) as repo:
         env_branch = progress_label(repo, args.next_tag, next_only=args.next_only)
-        repo.remotes.origin.push(env_branch)
+        push_refs(repo, [env_branch.path])
 
 
 def main():
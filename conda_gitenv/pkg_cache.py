@@ -0,0 +1,218 @@
+from __future__ import print_function
+
+import contextlib
+import errno
+from glob import glob
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from conda.gateways.disk.create import mkdir_p
+
+from conda_gitenv.extract import PACKAGE_EXTENSIONS, dist_name, is_extracted
+
+
+def cached_packages(pkgs_dir):
+    """
+    Return a dictionary mapping the distribution name of each package in
+    the package cache directory to the paths of its archives and extracted
+    directory.
+
+    """
+    packages = {}
+    if not os.path.isdir(pkgs_dir):
+        return packages
+    for name in os.listdir(pkgs_dir):
+        path = os.path.join(pkgs_dir, name)
+        if name.endswith(PACKAGE_EXTENSIONS) and os.path.isfile(path):
+            packages.setdefault(dist_name(name), []).append(path)
+        elif is_extracted(path):
+            packages.setdefault(name, []).append(path)
+    return packages
+
+
+def mark_used(pkgs_dir, dist_names):
+    """
+    Record that the packages of the given distribution names have just
+    been used by a deployment, by touching their archives and extracted
+    directories. The least recently used packages are the first to be
+    evicted by :func:`evict_packages`.
+
+    """
+    for name in dist_names:
+        paths = [os.path.join(pkgs_dir, name + extension)
+                 for extension in PACKAGE_EXTENSIONS]
+        paths.append(os.path.join(pkgs_dir, name))
+        for path in paths:
+            if os.path.exists(path):
+                os.utime(path, None)
+
+
+# The prefix of the files, in a package cache directory, recording the
+# packages in use by a deployment. See in_use.
+IN_USE_PREFIX = '.conda-gitenv-in-use-'
+
+#: The age (in seconds) beyond which a record of packages in use is
+#: considered to have been left behind by a deployment which crashed.
+IN_USE_MAX_AGE = 24 * 60 * 60
+
+
+@contextlib.contextmanager
+def in_use(pkgs_dir, dist_names):
+    """
+    A context manager which records, for its duration, that the packages
+    of the given distribution names are in use (e.g. being linked from the
+    package cache directory), such that :func:`evict_packages` doesn't
+    remove them, whichever process or host it runs in.
+
+    The record holds the host and process ID of its owner, such that it is
+    ignored once the owner is gone (see :func:`packages_in_use`).
+
+    """
+    mkdir_p(pkgs_dir)
+    fd, partial = tempfile.mkstemp(prefix=IN_USE_PREFIX, suffix='.partial',
+                                   dir=pkgs_dir)
+    with os.fdopen(fd, 'w') as fh:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(),
+                   'packages': sorted(dist_names)}, fh)
+    # Only complete records are read, see packages_in_use.
+    record = partial[:-len('.partial')]
+    os.rename(partial, record)
+    try:
+        yield
+    finally:
+        os.remove(record)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # Without permission to signal it, the process still exists.
+        return err.errno != errno.ESRCH
+    return True
+
+
+def _is_stale(record, age):
+    # Whether the record was left behind by a deployment which crashed.
+    # The process can only be checked on the host it ran on, so records
+    # from other hosts are only stale once they are too old.
+    if age > IN_USE_MAX_AGE:
+        return True
+    return (record['host'] == socket.gethostname() and
+            not _process_exists(record['pid']))
+
+
+def packages_in_use(pkgs_dir):
+    """
+    Return the distribution names of the packages of the package cache
+    directory which are in use (see :func:`in_use`).
+
+    Records left behind by deployments which crashed, being those of a
+    process which no longer exists or older than :data:`IN_USE_MAX_AGE`,
+    are removed rather than counted.
+
+    """
+    names = set()
+    for path in glob(os.path.join(pkgs_dir, IN_USE_PREFIX + '*')):
+        if path.endswith('.partial'):
+            continue
+        try:
+            age = time.time() - os.path.getmtime(path)
+            with open(path) as fh:
+                record = json.load(fh)
+            if _is_stale(record, age):
+                os.remove(path)
+                continue
+        except (IOError, OSError):
+            # The use ended while listing them.
+            continue
+        names.update(record['packages'])
+    return names
+
+
+def path_size(path):
+    """
+    Return the size in bytes of the given file, or of all of the files
+    within the given directory.
+
+    """
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        # Make the package look unextracted before removing the rest of it,
+        # such that a partial removal is never mistaken for a package.
+        os.remove(os.path.join(path, 'info', 'index.json'))
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def evict_packages(pkgs_dir, max_size, protected=(), tarballs_only=False):
+    """
+    Remove packages from the package cache directory, least recently used
+    first, until the cache fits within the given number of bytes. Return
+    the paths which were removed.
+
+    The archives of extracted packages are redundant once extracted, so
+    these are removed first, including those of the protected packages.
+    Unless only tarballs are to be removed, whole packages are then
+    removed, other than those of the given protected distribution names
+    (e.g. the packages of the labelled tags) and those in use by any
+    deployment (see :func:`in_use`).
+
+    """
+    packages = cached_packages(pkgs_dir)
+    sizes = {}
+    for paths in packages.values():
+        for path in paths:
+            sizes[path] = path_size(path)
+    total = sum(sizes.values())
+    if total <= max_size:
+        return []
+
+    def last_used(name):
+        return max(os.path.getmtime(path) for path in packages[name])
+
+    removed = []
+    order = sorted(packages, key=last_used)
+    for name in order:
+        if total <= max_size:
+            break
+        if is_extracted(os.path.join(pkgs_dir, name)):
+            for path in packages[name]:
+                if os.path.isfile(path):
+                    _remove_path(path)
+                    total -= sizes[path]
+                    removed.append(path)
+
+    if not tarballs_only:
+        protected = set(protected) | packages_in_use(pkgs_dir)
+        for name in order:
+            if total <= max_size:
+                break
+            if name in protected:
+                continue
+            for path in packages[name]:
+                if os.path.exists(path):
+                    _remove_path(path)
+                    total -= sizes[path]
+                    removed.append(path)
+
+    print('Evicted {} archives and packages from the package cache, '
+          'leaving {:.1f} MB'.format(len(removed), total / 1e6))
+    if total > max_size:
+        print('The package cache remains over its limit of {:.1f} MB'
+              ''.format(max_size / 1e6))
+    return removed
@@ -0,0 +1,170 @@
+from __future__ import print_function
+
+import contextlib
+import os
+import shutil
+import tempfile
+
+from conda.gateways.disk.create import mkdir_p
+
+from conda_gitenv.clone import link_file
+from conda_gitenv.extract import dist_name, is_extracted, legacy_url
+
+
+def store_dir(store, record):
+    """
+    Return the directory of the given package store which holds the package
+    of the given index record, or None if the record has no checksum.
+
+    A package store is shared between deployment targets, so packages are
+    keyed by their MD5 rather than by channel or filename, with both the
+    archive and the extracted package kept under it.
+
+    """
+    md5 = record.get('md5')
+    if not md5:
+        return None
+    return os.path.join(store, md5)
+
+
+def in_stores(stores, record):
+    """
+    Return whether any of the given package stores has the package of the
+    given index record.
+
+    """
+    for store in stores:
+        directory = store_dir(store, record)
+        if directory is None:
+            return False
+        name = dist_name(record['fn'])
+        if (is_extracted(os.path.join(directory, name)) or
+                os.path.isfile(os.path.join(directory, record['fn']))):
+            return True
+    return False
+
+
+def link_tree(source, target):
+    """
+    Hardlink (or copy, see :func:`conda_gitenv.clone.link_file`) the files
+    of the source directory into the (new) target directory.
+
+    The tree is built under a temporary name and renamed into place, so
+    that the target is either complete or missing. If another process (on
+    any host sharing the filesystem) got there first, its tree is kept.
+
+    """
+    with _staged(target) as tmp:
+        for dirpath, dirnames, filenames in os.walk(source):
+            directory = os.path.join(tmp, os.path.relpath(dirpath, source))
+            mkdir_p(directory)
+            # Symlinks to directories are listed (but not followed) as
+            # dirnames.
+            for name in filenames + [name for name in dirnames
+                                     if os.path.islink(os.path.join(dirpath,
+                                                                    name))]:
+                link_file(os.path.join(dirpath, name),
+                          os.path.join(directory, name))
+
+
+def _link_into(source, target):
+    # Link the source file to the target, atomically.
+    with _staged(target) as tmp:
+        link_file(source, tmp)
+
+
+@contextlib.contextmanager
+def _staged(target):
+    # Yield a temporary path, to be created, which is then renamed to the
+    # target. The path is within a uniquely named directory alongside the
+    # target (on the same filesystem), so that it can't collide with that
+    # of another process, on any host.
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(target) + '.',
+                               suffix='.tmp', dir=os.path.dirname(target))
+    try:
+        tmp = os.path.join(tmp_dir, os.path.basename(target))
+        yield tmp
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            # A directory can't be renamed over another, non-empty, one.
+            # Whichever got there first is kept.
+            if not os.path.exists(target):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def fetch_from_stores(index, dists, pkgs_dir, stores):
+    """
+    Link the packages of the given dists which aren't in the package cache
+    directory into it from the first of the given package stores to have
+    them, preferring an extracted package to an archive. Return the dists
+    which were found.
+
+    Where the store is on the same filesystem as the package cache, the
+    files are hardlinked, so the environments linked from the package
+    cache share their files with the store.
+
+    """
+    found = []
+    urls = []
+    for dist in dists:
+        record = index[dist]
+        fn = record['fn']
+        name = dist_name(fn)
+        extracted = os.path.join(pkgs_dir, name)
+        if is_extracted(extracted) or os.path.isfile(os.path.join(pkgs_dir,
+                                                                  fn)):
+            continue
+        for store in stores:
+            directory = store_dir(store, record)
+            if directory is None:
+                break
+            if is_extracted(os.path.join(directory, name)):
+                mkdir_p(pkgs_dir)
+                link_tree(os.path.join(directory, name), extracted)
+            elif os.path.isfile(os.path.join(directory, fn)):
+                mkdir_p(pkgs_dir)
+                _link_into(os.path.join(directory, fn),
+                           os.path.join(pkgs_dir, fn))
+            else:
+                continue
+            print('Linked {} from {}'.format(fn, store))
+            found.append(dist)
+            urls.append(legacy_url(record.get('url') or dist.to_url()))
+            break
+
+    if urls:
+        # As for downloaded packages, conda must know the URL of each.
+        with open(os.path.join(pkgs_dir, 'urls.txt'), 'a') as fh:
+            for url in urls:
+                fh.write(url + '\n')
+    return found
+
+
+def populate_stores(index, dists, pkgs_dir, stores):
+    """
+    Add the packages of the given dists, in their archive and extracted
+    forms, from the package cache directory to each of the given package
+    stores which doesn't yet have them.
+
+    """
+    for dist in dists:
+        record = index[dist]
+        fn = record['fn']
+        name = dist_name(fn)
+        archive = os.path.join(pkgs_dir, fn)
+        extracted = os.path.join(pkgs_dir, name)
+        for store in stores:
+            directory = store_dir(store, record)
+            if directory is None:
+                break
+            if (os.path.isfile(archive) and
+                    not os.path.isfile(os.path.join(directory, fn))):
+                mkdir_p(directory)
+                _link_into(archive, os.path.join(directory, fn))
+            if (is_extracted(extracted) and
+                    not is_extracted(os.path.join(directory, name))):
+                mkdir_p(directory)
+                link_tree(extracted, os.path.join(directory, name))
@@ -0,0 +1,68 @@
+import argparse
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+# The state given to the workers of the current pool, see worker_state.
+_worker_state = None
+
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+
+def worker_state():
+    """
+    Return the state given to :func:`pool_imap`, from within its worker.
+
+    """
+    return _worker_state
+
+
+def positive_int(value):
+    """
+    Return the given command line value as a number of at least one (e.g.
+    of jobs), for use as the type of an argparse argument.
+
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            '{} is not a positive integer'.format(value))
+    return number
+
+
+@contextlib.contextmanager
+def pool_imap(worker, tasks, jobs=1, state=None, ordered=False,
+              threads=False):
+    """
+    Yield an iterator of the results of calling the worker on each of the
+    tasks, using a pool of up to the given number of processes (or threads).
+
+    With a single job (or task) the tasks are run in this process instead.
+    Either way, the given state is available to the worker through
+    :func:`worker_state`. A process pool gives each worker a copy of the
+    state, so the worker must be a picklable top-level function.
+
+    The results come back in the order they complete, unless ordered. The
+    pool is terminated on leaving the context, including when a task fails.
+
+    """
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool_type = ThreadPool if threads else multiprocessing.Pool
+        pool = pool_type(min(jobs, len(tasks)), _init_worker, (state,))
+        if ordered:
+            results = pool.imap(worker, tasks)
+        else:
+            results = pool.imap_unordered(worker, tasks)
+    else:
+        _init_worker(state)
+        results = (worker(task) for task in tasks)
+    try:
+        yield results
+    finally:
+        if pool is not None:
+            pool.terminate()
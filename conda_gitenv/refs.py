@@ -0,0 +1,64 @@
+from __future__ import print_function
+
+from collections import namedtuple, OrderedDict
+
+
+#: A branch or tag of a :class:`RefSnapshot`. The commit_sha and
+#: committed_date are those of the commit the ref (or annotated tag) points
+#: to, and the object_type is that of the object the ref itself points to.
+Ref = namedtuple('Ref', ['name', 'path', 'object_type', 'object_sha',
+                         'commit_sha', 'committed_date'])
+
+
+# Tab separated, as tabs can't appear in ref names, with the ref name last
+# as the peeled fields are empty for anything other than annotated tags.
+_FORMAT = '%09'.join(['%(objecttype)', '%(objectname)', '%(*objectname)',
+                      '%(committerdate:raw)', '%(*committerdate:raw)',
+                      '%(refname)'])
+
+
+class RefSnapshot(object):
+    def __init__(self, repo):
+        """
+        A snapshot of the branches and tags of the given repo, read with a
+        single ``git for-each-ref`` call, providing hashed lookups by name
+        in place of scanning (and loading the objects of) ``repo.branches``
+        and ``repo.tags``.
+
+        The snapshot is not updated as refs are subsequently created, and
+        leaves out refs (i.e. tags) which don't point to a commit.
+
+        """
+        #: The branches of the repo, by name.
+        self.branches = OrderedDict()
+        #: The tags of the repo, by name.
+        self.tags = OrderedDict()
+
+        output = repo.git.for_each_ref('--format={}'.format(_FORMAT),
+                                       'refs/heads', 'refs/tags')
+        for line in output.splitlines():
+            (object_type, object_sha, peeled_sha, committer_date,
+             peeled_committer_date, path) = line.split('\t')
+            # Annotated tags need to be peeled to get to their commit.
+            commit_sha = peeled_sha or object_sha
+            date = peeled_committer_date or committer_date
+            if not date:
+                # Not a commit, e.g. a tag of a tree or blob.
+                continue
+            committed_date = int(date.split()[0])
+            if path.startswith('refs/heads/'):
+                refs, name = self.branches, path[len('refs/heads/'):]
+            else:
+                refs, name = self.tags, path[len('refs/tags/'):]
+            refs[name] = Ref(name, path, object_type, object_sha,
+                             commit_sha, committed_date)
+
+    def tags_by_commit(self):
+        """
+        Return a dictionary mapping commit SHA to the list of tags of it.
+
+        """
+        tags = {}
+        for tag in self.tags.values():
+            tags.setdefault(tag.commit_sha, []).append(tag)
+        return tags
@@ -13,25 +13,42 @@ from __future__ import print_function
 import datetime
 import contextlib
 from fnmatch import fnmatch
+import hashlib
+import json
 import logging
 import os
 import shutil
 import tempfile
 import warnings
 
+from io import BytesIO
+try:
+    # Python3...
+    from io import StringIO
+except ImportError:
+    # Python2...
+    from StringIO import StringIO
+
 import conda.api
 import conda.resolve
 import conda_build_all.version_matrix
-from git import Repo
+from git import (Blob, Commit, GitCommandError, Head, IndexFile, PushInfo,
+                 Repo)
+from git.index.typ import BaseIndexEntry
+from gitdb import IStream
 import yaml
 
-from conda_gitenv import manifest_branch_prefix
+from conda_gitenv import fingerprint_notes_ref, manifest_branch_prefix
+from conda_gitenv.extract import dist_name
+from conda_gitenv.index import IndexRegistry
+from conda_gitenv.lock import Locked
+from conda_gitenv.pool import pool_imap, positive_int, worker_state
+from conda_gitenv.refs import RefSnapshot
 
 
-def resolve_spec(spec_fh, api_user, api_key):
+def inject_credentials(urls, api_user, api_key):
     """
-    Given an open file handle to an env.spec, return a list of strings
-    containing '<channel_url>\t<pkg_name>' for each package resolved.
+    Return the given channel URLs with the API user and key injected.
 
     """
     try:
@@ -41,41 +58,238 @@ def resolve_spec(spec_fh, api_user, api_key):
         # Python2...
         from urlparse import urlparse
 
-    spec = yaml.safe_load(spec_fh)
-    env_spec = spec.get('env', [])
-    channels = spec.get('channels', [])
-
-    # Inject the API user and key into the channel URLs...
+    urls = list(urls)
     if api_user and api_key:
-        for i, url in enumerate(channels):
+        for i, url in enumerate(urls):
             parts = urlparse(url)
             api_url = '{}://{}:{}@{}{}'.format(parts.scheme, api_user, api_key,
                                                parts.netloc, parts.path)
-            channels[i] = api_url
+            urls[i] = api_url
+    return urls
+
+
+def spec_channels(spec, api_user=None, api_key=None):
+    """
+    Return the channel URLs of a parsed env.spec, ready for fetching.
+
+    """
+    return inject_credentials(spec.get('channels', []), api_user, api_key)
+
+
+def strip_credentials(url):
+    """
+    Return the given URL without any API user and key injected into it.
+
+    """
+    try:
+        # Python3...
+        from urllib.parse import urlparse, urlunparse
+    except ImportError:
+        # Python2...
+        from urlparse import urlparse, urlunparse
+
+    parts = urlparse(url)
+    netloc = parts.netloc.rpartition('@')[2]
+    return urlunparse(parts._replace(netloc=netloc))
+
+
+#: The fields of a package's index record which are kept in env.lock.json.
+LOCK_FIELDS = ['build', 'build_number', 'channel', 'depends', 'fn', 'md5',
+               'name', 'schannel', 'sha256', 'size', 'subdir', 'url',
+               'version']
+
+
+def lock_record(pkg_info):
+    """
+    Return the env.lock.json record of the given package index record,
+    holding everything needed to download and install the package.
+
+    """
+    record = {}
+    for field in LOCK_FIELDS:
+        value = pkg_info.get(field)
+        if value is not None:
+            record[field] = value
+    record['depends'] = list(record.get('depends', []))
+    # The lock file is committed, so mustn't contain any credentials.
+    for field in ['channel', 'url']:
+        if field in record:
+            record[field] = strip_credentials(record[field])
+    return record
+
+
+def manifest_lines(records):
+    """
+    Given a list of env.lock.json records, return a list of strings
+    containing '<channel_url>\t<pkg_name>' for each package.
+
+    """
+    return ['\t'.join([os.path.join(record['schannel'], record['subdir']),
+                       dist_name(record['fn'])])
+            for record in records]
+
 
-    index = conda.api.get_index(channels, prepend=False, use_cache=False)
+def resolve_lock(spec_fh, api_user, api_key, index_registry=None):
+    """
+    Given an open file handle to an env.spec, return a list of the
+    env.lock.json record of each package resolved, sorted by name.
+
+    If an :class:`~conda_gitenv.index.IndexRegistry` is given, the channel
+    index is taken from (and shared through) the registry.
+
+    """
+    spec = yaml.safe_load(spec_fh)
+    env_spec = spec.get('env', [])
+    channels = spec_channels(spec, api_user, api_key)
+
+    if index_registry is None:
+        index = conda.api.get_index(channels, prepend=False, use_cache=False)
+    else:
+        index = index_registry.get_index(channels)
     resolver = conda.resolve.Resolve(index)
     packages = sorted(resolver.solve(env_spec),
                       key=lambda pkg: pkg.dist_name.lower())
+    return [lock_record(index[pkg]) for pkg in packages]
+
+
+def resolve_spec(spec_fh, api_user, api_key, index_registry=None):
+    """
+    Given an open file handle to an env.spec, return a list of strings
+    containing '<channel_url>\t<pkg_name>' for each package resolved.
+
+    If an :class:`~conda_gitenv.index.IndexRegistry` is given, the channel
+    index is taken from (and shared through) the registry.
+
+    """
+    return manifest_lines(resolve_lock(spec_fh, api_user, api_key,
+                                       index_registry=index_registry))
+
+
+def _spec_blob(commit):
+    try:
+        return commit.tree / 'env.spec'
+    except KeyError:
+        return None
+
+
+def read_file(commit, path):
+    """
+    Return the text of the file at the given path of the commit's tree, or
+    None if there is no such file. The working tree is not touched.
+
+    """
+    try:
+        blob = commit.tree / path
+    except KeyError:
+        return None
+    return blob.data_stream.read().decode('utf-8')
+
+
+def manifest_sha(commit):
+    """
+    Return the content hash (i.e. the git blob SHA) of the env.manifest of
+    the given commit, or None if there is no manifest. Commits with
+    identical manifests, and so identical packages, have the same hash.
+
+    """
+    try:
+        return (commit.tree / 'env.manifest').hexsha
+    except KeyError:
+        return None
+
+
+def read_spec(branch):
+    """
+    Return the text of the env.spec committed on the given branch, or None
+    if the branch doesn't have a spec. The working tree is not touched.
 
-    pkgs = []
-    for pkg in packages:
-        pkg_info = index[pkg]
-        pkgs.append('\t'.join([os.path.join(pkg_info['schannel'],
-                                            pkg_info['subdir']),
-                               pkg_info['fn'][:-len('.tar.bz2')]]))
-    return pkgs
+    """
+    return read_file(branch.commit, 'env.spec')
+
+
+def read_lock(commit):
+    """
+    Return the list of package records of the env.lock.json committed in
+    the given commit, or None if there isn't one (as is the case for
+    manifests resolved before the lock file was introduced).
+
+    """
+    text = read_file(commit, 'env.lock.json')
+    if text is None:
+        return None
+    return json.loads(text)['packages']
+
+
+def spec_fingerprint(spec_blob, index_registry, channels):
+    """
+    Return a fingerprint of the inputs to resolving an environment, namely
+    the env.spec blob and a snapshot of the repodata of its channels.
+
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(spec_blob.hexsha.encode('ascii'))
+    fingerprint.update(index_registry.fingerprint(channels).encode('ascii'))
+    return fingerprint.hexdigest()
+
+
+def read_fingerprint(repo, commit):
+    """
+    Return the resolve fingerprint recorded against the given manifest
+    commit, or None if there isn't one.
+
+    """
+    try:
+        return repo.git.notes('--ref', fingerprint_notes_ref,
+                              'show', commit.hexsha).strip()
+    except GitCommandError:
+        return None
 
 
-def build_manifest_branches(repo, api_user=None, api_key=None, envs=None):
+def write_fingerprint(repo, commit, fingerprint):
+    """
+    Record the resolve fingerprint against the given manifest commit.
+
+    """
+    repo.git.notes('--ref', fingerprint_notes_ref, 'add', '--force',
+                   '--message', fingerprint, commit.hexsha)
+
+
+def _resolve_env(task):
+    # Resolve a single environment. This is the unit of work handed to
+    # each process of the pool, so it must be a picklable top-level function.
+    index_registry = worker_state()
+    counts = index_registry.counts()
+    name, spec_text, api_user, api_key = task
+    records = resolve_lock(StringIO(spec_text), api_user, api_key,
+                           index_registry=index_registry)
+    return name, spec_text, records, index_registry.take_counts(counts)
+
+
+def build_manifest_branches(repo, api_user=None, api_key=None, envs=None,
+                            jobs=1, index_registry=None, force=False):
+    """
+    Resolve the env.spec of each environment branch into a commit on the
+    equivalent manifest branch, returning the names of the environments
+    which were resolved (i.e. not skipped).
+
+    """
     for remote in repo.remotes:
         remote.fetch()
+        try:
+            remote.fetch('+{0}:{0}'.format(fingerprint_notes_ref))
+        except GitCommandError:
+            # The remote doesn't have any fingerprints yet.
+            pass
 
     if envs is None:
         envs = ['*']
+    if index_registry is None:
+        index_registry = IndexRegistry()
 
-    for branch in repo.branches:
-        name = branch.name
+    refs = RefSnapshot(repo)
+    tasks = []
+    fingerprints = {}
+    for name, branch in refs.branches.items():
         if name.startswith(manifest_branch_prefix):
             continue
         if '-' in name:
@@ -85,34 +299,88 @@ def build_manifest_branches(repo, api_user=None, api_key=None, envs=None):
         if not any([fnmatch(name, env) for env in envs]):
             # Skip non-specific environments.
             continue
-        branch.checkout()
-        spec_fname = os.path.join(repo.working_dir, 'env.spec')
-        if not os.path.exists(spec_fname):
+        spec_blob = _spec_blob(repo.commit(branch.commit_sha))
+        if spec_blob is None:
             # Skip branches which don't have a spec.
             continue
-        with open(spec_fname, 'r') as fh:
-            pkgs = resolve_spec(fh, api_user, api_key)
-            # Cache the contents of the env.spec file from the source branch.
-            fh.seek(0)
-            spec_lines = fh.readlines()
+        spec_text = spec_blob.data_stream.read().decode('utf-8')
+
+        # Skip branches whose spec and channel repodata are unchanged since
+        # the manifest was last resolved. Computing the fingerprint also
+        # populates the index registry, so that when resolving in parallel
+        # each channel is fetched once here rather than once per worker.
+        channels = spec_channels(yaml.safe_load(spec_text), api_user, api_key)
+        fingerprint = spec_fingerprint(spec_blob, index_registry, channels)
         manifest_branch_name = '{}{}'.format(manifest_branch_prefix, name)
-        if manifest_branch_name in repo.branches:
-            manifest_branch = repo.branches[manifest_branch_name]
-        else:
-            manifest_branch = repo.create_head(manifest_branch_name)
-        manifest_branch.checkout()
-        manifest_path = os.path.join(repo.working_dir, 'env.manifest')
-        with open(manifest_path, 'w') as fh:
-            fh.write('\n'.join(pkgs))
-            # Ensure the manifest has a trailing newline.
-            fh.write('\n')
-        # Write the env.spec from the source branch into the manifest branch.
-        with open(spec_fname, 'w') as fh:
-            fh.writelines(spec_lines)
-        repo.index.add([manifest_path, spec_fname])
-        if repo.is_dirty():
-            repo.index.commit('Manifest update from {:%Y-%m-%d %H:%M:%S}.'
-                              ''.format(datetime.datetime.now()))
+        manifest_branch = refs.branches.get(manifest_branch_name)
+        if not force and manifest_branch is not None:
+            manifest_commit = repo.commit(manifest_branch.commit_sha)
+            if read_fingerprint(repo, manifest_commit) == fingerprint:
+                continue
+        fingerprints[name] = fingerprint
+        tasks.append((name, spec_text, api_user, api_key))
+
+    # The solves are independent of one another, so farm them out to a
+    # pool of processes. The results come back in order, meaning that the
+    # manifest commits below are made in the same order as a serial run.
+    resolved = []
+    with pool_imap(_resolve_env, tasks, jobs=jobs, state=index_registry,
+                   ordered=True) as results:
+        for name, spec_text, records, counts in results:
+            index_registry.add_counts(counts)
+            manifest_branch_name = '{}{}'.format(manifest_branch_prefix, name)
+            if manifest_branch_name in refs.branches:
+                manifest_branch = Head(repo, refs.branches[
+                    manifest_branch_name].path)
+                parent = manifest_branch.commit
+            else:
+                manifest_branch = None
+                parent = repo.commit(refs.branches[name].commit_sha)
+            # Ensure the manifest has a trailing newline, and write the
+            # env.spec from the source branch into the manifest branch.
+            # The lock file holds the full record of each package, such
+            # that it can be deployed without fetching any repodata.
+            manifest = '\n'.join(manifest_lines(records))
+            lock = json.dumps({'packages': records}, indent=2, sort_keys=True)
+            files = {'env.manifest': manifest + '\n',
+                     'env.lock.json': lock + '\n',
+                     'env.spec': spec_text}
+            message = ('Manifest update from {:%Y-%m-%d %H:%M:%S}.'
+                       ''.format(datetime.datetime.now()))
+            commit = commit_files(repo, parent, files, message)
+            if manifest_branch is None:
+                manifest_branch = repo.create_head(manifest_branch_name, commit)
+            elif commit != parent:
+                manifest_branch.commit = commit
+            write_fingerprint(repo, commit, fingerprints[name])
+            resolved.append(name)
+    return resolved
+
+
+def commit_files(repo, parent, files, message):
+    """
+    Commit the given files, a dictionary mapping path to text content, on
+    top of the parent commit and return the new commit. If the files are
+    unchanged, no commit is made and the parent is returned.
+
+    The commit is made directly in the object database, so neither the
+    working tree nor the index of the repo is touched (and the repo may
+    be bare). No branch is updated to point to the new commit.
+
+    """
+    index = IndexFile.from_tree(repo, parent.tree)
+    entries = []
+    for path, content in sorted(files.items()):
+        data = content.encode('utf-8')
+        istream = repo.odb.store(IStream(Blob.type, len(data), BytesIO(data)))
+        entries.append(BaseIndexEntry((Blob.file_mode, istream.binsha,
+                                       0, path)))
+    index.add(entries, write=False)
+    tree = index.write_tree()
+    if tree == parent.tree:
+        return parent
+    return Commit.create_from_tree(repo, tree, message,
+                                   parent_commits=[parent], head=False)
 
 
 @contextlib.contextmanager
@@ -145,6 +413,113 @@ def create_tracking_branches(repo):
             repo.create_head(ref.remote_head, ref).set_tracking_branch(ref)
 
 
+def push_refs(repo, refs):
+    """
+    Push the given refs (full ref names, such as "refs/tags/<name>") to
+    the origin in a single atomic push, reporting the status of each.
+    Either all of the refs are updated on the origin, or none of them are.
+
+    """
+    if not refs:
+        return
+    refspecs = ['{0}:{0}'.format(ref) for ref in refs]
+    push_infos = repo.remotes.origin.push(refspecs, atomic=True)
+    failed = PushInfo.ERROR | PushInfo.REJECTED | PushInfo.REMOTE_REJECTED
+    failures = []
+    for push_info in push_infos:
+        print('{}: {}'.format(push_info.remote_ref_string,
+                              push_info.summary.strip()))
+        if push_info.flags & failed:
+            failures.append(push_info.remote_ref_string)
+    if failures:
+        raise RuntimeError('Failed to push {}.'.format(', '.join(failures)))
+
+
+def mirror_path(repo_uri, cache_dir):
+    """
+    Return the location of the bare mirror of the given repo within the
+    cache directory.
+
+    """
+    digest = hashlib.sha1(repo_uri.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{}.git'.format(digest))
+
+
+def update_mirror(repo_uri, cache_dir):
+    """
+    Create, or incrementally fetch into, the bare mirror of the given repo
+    within the cache directory and return its location. The mirror is
+    locked whilst being updated, so that concurrent commands may share it.
+
+    """
+    path = mirror_path(repo_uri, cache_dir)
+    with Locked(path):
+        if os.path.isdir(path):
+            Repo(path).remotes.origin.fetch(prune=True)
+        else:
+            Repo.clone_from(repo_uri, path, mirror=True)
+    return path
+
+
+def narrow_clone(repo_uri, directory, refspecs, shared=False):
+    """
+    Clone only the given fetch refspecs of the repo into the directory.
+
+    If shared, the repo must be local and its objects are borrowed rather
+    than copied. Otherwise the clone is a partial clone, fetching commits
+    and trees but no blobs, the latter being fetched on demand (e.g. upon
+    checkout) from the origin.
+
+    """
+    repo = Repo.init(directory)
+    if shared:
+        alternates = os.path.join(repo.git_dir, 'objects', 'info',
+                                  'alternates')
+        with open(alternates, 'w') as fh:
+            fh.write(os.path.join(os.path.abspath(repo_uri), 'objects') + '\n')
+    repo.create_remote('origin', repo_uri)
+    repo.git.config('--unset-all', 'remote.origin.fetch')
+    for refspec in refspecs:
+        repo.git.config('--add', 'remote.origin.fetch', refspec)
+    if not shared:
+        repo.git.config('core.repositoryformatversion', '1')
+        repo.git.config('extensions.partialClone', 'origin')
+        repo.git.config('remote.origin.promisor', 'true')
+        repo.git.config('remote.origin.partialCloneFilter', 'blob:none')
+    repo.git.fetch('origin')
+    return repo
+
+
+@contextlib.contextmanager
+def cloned_repo(repo_uri, cache_dir=None, refspecs=None):
+    """
+    A context manager providing a temporary clone of the given repo, with
+    local tracking branches for each of the remote's branches.
+
+    If a cache directory is given, a bare mirror of the repo is kept there
+    between runs and updated incrementally. The clone is then made from the
+    mirror, sharing its objects rather than fetching them afresh, but with
+    its origin still pointing to the given repo.
+
+    If fetch refspecs are given, only those refs are cloned (see
+    :func:`narrow_clone`), rather than every branch and tag.
+
+    """
+    with tempdir() as repo_directory:
+        source = repo_uri
+        if cache_dir is not None:
+            source = update_mirror(repo_uri, cache_dir)
+        shared = source != repo_uri
+        if refspecs is None:
+            repo = Repo.clone_from(source, repo_directory, shared=shared)
+        else:
+            repo = narrow_clone(source, repo_directory, refspecs,
+                                shared=shared)
+        repo.remotes.origin.set_url(repo_uri)
+        create_tracking_branches(repo)
+        yield repo
+
+
 def configure_parser(parser):
     msg = 'Repo to use for environment tracking.'
     parser.add_argument('repo_uri', help=msg)
@@ -154,6 +529,21 @@ def configure_parser(parser):
                         help='the API user')
     parser.add_argument('--envs', '-e', nargs='+', default=['*'],
                         help='the environment names to resolve')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=1,
+                        help='the number of environments to resolve '
+                             'concurrently')
+    parser.add_argument('--index-cache-dir', action='store',
+                        help='the directory in which to persist channel '
+                             'repodata between runs')
+    parser.add_argument('--max-index-age', type=int, default=None,
+                        help='the age (in seconds) within which cached '
+                             'repodata is used without revalidation')
+    parser.add_argument('--cache-dir', action='store',
+                        help='the directory in which to keep a mirror of '
+                             'the repo between runs')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='resolve every environment, even those whose '
+                             'spec and repodata are unchanged')
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.set_defaults(function=handle_args)
     return parser
@@ -164,18 +554,30 @@ def handle_args(args):
     if args.verbose:
         log_level = logging.DEBUG
     with conda_build_all.version_matrix.override_conda_logging(log_level):
-        with tempdir() as repo_directory:
-            repo = Repo.clone_from(args.repo_uri, repo_directory)
-            create_tracking_branches(repo)
-            build_manifest_branches(repo, api_user=args.api_user,
-                                    api_key=args.api_key, envs=args.envs)
-            for branch in repo.branches:
-                if branch.name.startswith(manifest_branch_prefix):
-                    remote_branch = branch.tracking_branch()
-                    if (remote_branch is None or
-                            branch.commit != remote_branch.commit):
-                        print('Pushing changes to {}'.format(branch.name))
-                        repo.remotes.origin.push(branch)
+        with cloned_repo(args.repo_uri, args.cache_dir) as repo:
+            index_registry = IndexRegistry(cache_dir=args.index_cache_dir,
+                                           max_age=args.max_index_age)
+            resolved = build_manifest_branches(repo, api_user=args.api_user,
+                                               api_key=args.api_key,
+                                               envs=args.envs, jobs=args.jobs,
+                                               index_registry=index_registry,
+                                               force=args.force)
+            if args.verbose:
+                print(index_registry.summary())
+            refs = []
+            for name in resolved:
+                branch = Head(repo, 'refs/heads/{}{}'.format(
+                    manifest_branch_prefix, name))
+                remote_branch = branch.tracking_branch()
+                if (remote_branch is None or
+                        branch.commit != remote_branch.commit):
+                    print('Pushing changes to {}'.format(branch.name))
+                    refs.append(branch.path)
+            # The fingerprints are notes on the manifest commits, so are
+            # pushed alongside the manifest branches.
+            if resolved:
+                refs.append(fingerprint_notes_ref)
+            push_refs(repo, refs)
 
 
 def main():
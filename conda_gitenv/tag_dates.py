@@ -2,48 +2,96 @@
 from __future__ import print_function
 
 import datetime
+import re
 import time
 
-from git import Repo
-from conda_gitenv.resolve import tempdir, create_tracking_branches
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.resolve import cloned_repo, manifest_sha, push_refs
 
 
 manifest_branch_prefix = 'manifest/'
 
+#: The name of an automatic tag, of the form env-<env>-<date>[-<count>].
+tag_pattern = re.compile(r'^env-(?P<env>.+)-\d{4}_\d{2}_\d{2}(-\d+)?$')
+
 
 def tag_by_branch(repo):
     # Iterate through each of the branches, and tag any changes with
     # the branch's commit timestamp.
-    repo_tags_by_commit = {tag.commit: tag for tag in repo.tags}
-    for branch in repo.branches:
+    refs = RefSnapshot(repo)
+    tagged_commits = refs.tags_by_commit()
+    tag_names = set(refs.tags)
+    for branch in refs.branches.values():
         if branch.name.startswith(manifest_branch_prefix):
-            sha = branch.commit
             env_name = branch.name[len(manifest_branch_prefix):]
-            commit_date = datetime.datetime(*time.gmtime(sha.committed_date)[:6])
-            if sha not in repo_tags_by_commit:
+            commit_date = datetime.datetime(*time.gmtime(branch.committed_date)[:6])
+            if branch.commit_sha not in tagged_commits:
                 tag_prefix = 'env-{}-{:%Y_%m_%d}'.format(env_name, commit_date)
                 count, proposed_tag = 0, tag_prefix
-                while proposed_tag in repo.tags:
+                while proposed_tag in tag_names:
                     count += 1
                     proposed_tag = '{}-{}'.format(tag_prefix, count)
-                tag = repo.create_tag(proposed_tag, ref=branch,
-                                      message="Automatic tag of {}.".format(env_name))
+                # Record the manifest content hash, which is the same for
+                # any tags of identical packages.
+                message = 'Automatic tag of {}.\n\nManifest: {}'.format(
+                    env_name, manifest_sha(repo.commit(branch.commit_sha)))
+                tag = repo.create_tag(proposed_tag, ref=branch.path,
+                                      message=message)
+                tag_names.add(proposed_tag)
                 yield tag
 
 
+def unchanged_tags(repo, refs, tags):
+    """
+    Return the names of those of the given (new) tags whose env.manifest is
+    identical to that of the latest tag of the same environment in the
+    given snapshot of the repo's refs, i.e. the tags with no package
+    changes (only the env.spec changed, for instance).
+
+    """
+    latest = {}
+    for tag in refs.tags.values():
+        match = tag_pattern.match(tag.name)
+        if match:
+            env_name = match.group('env')
+            if (env_name not in latest or
+                    tag.committed_date > latest[env_name].committed_date):
+                latest[env_name] = tag
+    unchanged = set()
+    for tag in tags:
+        match = tag_pattern.match(tag.name)
+        previous = latest.get(match.group('env')) if match else None
+        if (previous is not None and
+                manifest_sha(repo.commit(previous.commit_sha)) ==
+                manifest_sha(tag.commit)):
+            unchanged.add(tag.name)
+    return unchanged
+
+
 def configure_parser(parser):
     parser.add_argument('repo_uri', help='Repo to push tags to.')
+    parser.add_argument('--cache-dir', action='store',
+                        help='the directory in which to keep a mirror of '
+                             'the repo between runs')
     parser.set_defaults(function=handle_args)
     return parser
 
 
 def handle_args(args):
-    with tempdir() as repo_directory:
-        repo = Repo.clone_from(args.repo_uri, repo_directory)
-        create_tracking_branches(repo)
-        for tag in tag_by_branch(repo):
-            print('Pushing tag {}'.format(tag.name))
-            repo.remotes.origin.push(tag)
+    # Only the manifest branches and the existing tags are needed.
+    refspecs = ['+refs/heads/{0}*:refs/remotes/origin/{0}*'
+                ''.format(manifest_branch_prefix),
+                '+refs/tags/*:refs/tags/*']
+    with cloned_repo(args.repo_uri, args.cache_dir, refspecs) as repo:
+        refs = RefSnapshot(repo)
+        tags = list(tag_by_branch(repo))
+        unchanged = unchanged_tags(repo, refs, tags)
+        for tag in tags:
+            if tag.name in unchanged:
+                print('Pushing tag {} (no package change)'.format(tag.name))
+            else:
+                print('Pushing tag {}'.format(tag.name))
+        push_refs(repo, [tag.path for tag in tags])
 
 
 def main():
@@ -62,6 +62,33 @@ class Test(unittest.TestCase):
             # Check that we can resolve those links, finding the python executable.
             self.assertTrue(os.path.exists(os.path.join(tmpdir, 'bleeding', 'next', 'bin', 'python')))
 
+    def test_parallel(self):
+        with resolve.tempdir() as tmpdir:
+            deploy.deploy_repo(self.repo, tmpdir, jobs=2)
+
+            for env, label in [('default', 'next'), ('default', 'current'),
+                               ('bleeding', 'next')]:
+                self.assertTrue(self.check_link_exists(tmpdir, env, label))
+                prefix = os.path.join(tmpdir, env, label)
+                self.assertTrue(os.path.exists(os.path.join(prefix, 'bin',
+                                                            'python')))
+                self.assertIsNotNone(deploy.read_deployed_marker(prefix))
+
+    def test_plan(self):
+        with resolve.tempdir() as tmpdir:
+            plan = deploy.plan_deploy(self.repo, tmpdir)
+            self.assertEqual(len(plan['deploy']), 3)
+            self.assertGreater(plan['download']['bytes'], 0)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            deploy.execute_plan(plan, tmpdir)
+            self.assertTrue(self.check_link_exists(tmpdir, 'default', 'next'))
+            plan = deploy.plan_deploy(self.repo, tmpdir)
+            self.assertEqual(plan['deploy'], [])
+            self.assertEqual(plan['download']['packages'], [])
+            self.assertTrue(all(entry['current'] == entry['target']
+                                for entry in plan['labels']))
+
     def test_specified_env_labels(self):
         with resolve.tempdir() as tmpdir:
             deploy.deploy_repo(self.repo, tmpdir, ['default/next', 'bleeding/*'])
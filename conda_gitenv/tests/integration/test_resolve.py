@@ -4,6 +4,9 @@ import textwrap
 import unittest
 from subprocess import check_call
 
+from git import Repo
+
+from conda_gitenv import resolve
 import conda_gitenv.tests.integration.setup_samples as setup_samples
 
 
@@ -51,6 +54,62 @@ class Test_full_build(unittest.TestCase):
             env_spec = [entry.strip() for entry in fh.readlines()]
         self.assertIn('- numpy', env_spec)
 
+    def test_parallel_envs(self):
+        repo = setup_samples.create_repo('parallel_envs')
+        setup_samples.add_env(repo, 'master', """
+            env:
+             - python
+            channels:
+             - defaults
+            """)
+        setup_samples.add_env(repo, 'legacy', """
+            env:
+             - python 2.*
+            channels:
+             - defaults
+            """)
+        resolve.build_manifest_branches(repo, jobs=2)
+
+        for name in ['master', 'legacy']:
+            manifest = repo.branches['manifest/{}'.format(name)]
+            self.assertEqual(resolve.read_spec(manifest),
+                             resolve.read_spec(repo.branches[name]))
+            blob = manifest.commit.tree / 'env.manifest'
+            pkgs = blob.data_stream.read().decode('utf-8').splitlines()
+            pkg_names = [pkg.split('\t', 1)[1].split('-')[0]
+                         for pkg in pkgs]
+            self.assertIn('python', pkg_names)
+
+    def test_bare_repo(self):
+        repo = setup_samples.basic_repo('bare_source')
+        with resolve.tempdir() as bare_dir:
+            bare = Repo.clone_from(repo.working_dir, bare_dir, mirror=True)
+            self.assertTrue(bare.bare)
+            resolve.build_manifest_branches(bare)
+
+            self.assertIn('manifest/master', bare.branches)
+            manifest = bare.branches['manifest/master']
+            blob = manifest.commit.tree / 'env.manifest'
+            pkgs = blob.data_stream.read().decode('utf-8').splitlines()
+            pkg_names = [pkg.split('\t', 1)[1].split('-')[0] for pkg in pkgs]
+            self.assertIn('python', pkg_names)
+
+    def test_unchanged_env_skipped(self):
+        repo = setup_samples.basic_repo('unchanged_env')
+        self.assertEqual(resolve.build_manifest_branches(repo), ['master'])
+        manifest = repo.branches['manifest/master']
+        self.assertIsNotNone(resolve.read_fingerprint(repo, manifest.commit))
+
+        # With neither the spec nor the repodata having changed, the
+        # environment is not resolved again.
+        self.assertEqual(resolve.build_manifest_branches(repo), [])
+        self.assertEqual(repo.branches['manifest/master'].commit,
+                         manifest.commit)
+
+        # Unless forced to.
+        self.assertEqual(resolve.build_manifest_branches(repo, force=True),
+                         ['master'])
+
 
 if __name__ == '__main__':
     unittest.main()
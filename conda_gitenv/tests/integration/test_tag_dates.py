@@ -5,7 +5,9 @@ import unittest
 from subprocess import check_call
 
 import conda_gitenv.tests.integration.setup_samples as setup_samples
-from conda_gitenv.tag_dates import tag_by_branch
+from conda_gitenv.resolve import cloned_repo, mirror_path, tempdir
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.tag_dates import tag_by_branch, unchanged_tags
 
 
 class Test_tag_by_date(unittest.TestCase):
@@ -17,6 +19,48 @@ class Test_tag_by_date(unittest.TestCase):
         self.assertEqual(new_tags[0].commit, env.commit)
 
 
+class Test_unchanged_tags(unittest.TestCase):
+    def commit(self, repo, branch, filename, content):
+        branch.checkout()
+        path = os.path.join(repo.working_dir, filename)
+        with open(path, 'w') as fh:
+            fh.write(content)
+        repo.index.add([path])
+        repo.index.commit('Update {}.'.format(filename))
+
+    def test(self):
+        repo = setup_samples.create_repo('unchanged_tags')
+        env = repo.create_head('manifest/example_env')
+        self.commit(repo, env, 'env.manifest', 'foo-1-0\n')
+        first, = tag_by_branch(repo)
+        self.assertIn('Manifest: ', first.tag.message)
+
+        # Only the spec changes, so the manifest hash is the same.
+        self.commit(repo, env, 'env.spec', 'env: [foo]\n')
+        refs = RefSnapshot(repo)
+        tags = list(tag_by_branch(repo))
+        self.assertEqual(unchanged_tags(repo, refs, tags),
+                         set([tags[0].name]))
+        self.assertEqual(tags[0].tag.message, first.tag.message)
+
+        self.commit(repo, env, 'env.manifest', 'foo-2-0\n')
+        refs = RefSnapshot(repo)
+        tags = list(tag_by_branch(repo))
+        self.assertEqual(unchanged_tags(repo, refs, tags), set())
+
+
+class Test_narrow_clone(unittest.TestCase):
+    def test(self):
+        repo = setup_samples.create_repo('narrow_clone')
+        repo.create_head('example_env')
+        repo.create_head('manifest/example_env')
+        refspecs = ['+refs/heads/manifest/*:refs/remotes/origin/manifest/*']
+        with cloned_repo(repo.working_dir, refspecs=refspecs) as clone:
+            self.assertEqual([branch.name for branch in clone.branches],
+                             ['manifest/example_env'])
+            self.assertEqual(clone.remotes.origin.url, repo.working_dir)
+
+
 class Test_cli(unittest.TestCase):
     def test(self):
         repo = setup_samples.create_repo('tag_by_date')
@@ -26,6 +70,24 @@ class Test_cli(unittest.TestCase):
 
         self.assertEqual(repo.tags[0].commit, env.commit)
 
+    def test_cache_dir(self):
+        repo = setup_samples.create_repo('tag_by_date')
+        env = repo.create_head('manifest/example_env')
+
+        with tempdir() as cache_dir:
+            check_call(['conda', 'gitenv', 'autotag', repo.working_dir,
+                        '--cache-dir', cache_dir])
+            self.assertTrue(os.path.isdir(mirror_path(repo.working_dir,
+                                                      cache_dir)))
+            self.assertEqual(len(repo.tags), 1)
+
+            # A second environment is picked up through the existing mirror.
+            commit = repo.index.commit('Another commit.', head=False)
+            repo.create_head('manifest/other_env', commit)
+            check_call(['conda', 'gitenv', 'autotag', repo.working_dir,
+                        '--cache-dir', cache_dir])
+            self.assertEqual(len(repo.tags), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,101 @@
+"""
+Fixtures shared between the unit tests.
+
+"""
+import hashlib
+import io
+import os
+import tarfile
+import threading
+
+try:
+    # Python3...
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python2...
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def assert_raises_regex(test_case, exception, regex):
+    """
+    Return the context manager of the test case's assertRaisesRegex.
+
+    """
+    # Python 2 only has the (since deprecated) assertRaisesRegexp.
+    method = (getattr(test_case, 'assertRaisesRegex', None) or
+              test_case.assertRaisesRegexp)
+    return method(exception, regex)
+
+
+def write_package(pkgs_dir, fn):
+    """
+    Write a minimal .tar.bz2 package, of the given filename, into the
+    directory.
+
+    """
+    with tarfile.open(os.path.join(pkgs_dir, fn), 'w:bz2') as tar:
+        content = b'{}'
+        info = tarfile.TarInfo('info/index.json')
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+
+
+class ChannelHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for a remote channel, serving the files of a local channel
+    directory and honouring conditional requests through the ETag header.
+
+    """
+    #: The channel directory being served.
+    root = None
+    #: The status code of every request made, in order.
+    statuses = []
+    #: Whether to cut each response short, as if the connection dropped.
+    truncate = False
+
+    def do_GET(self):
+        path = os.path.join(self.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.statuses.append(404)
+            self.send_error(404)
+            return
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.truncate:
+            content = content[:len(content) // 2]
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ChannelServerMixin(object):
+    """
+    A TestCase mixin which serves a channel with :class:`ChannelHandler`
+    for the duration of each test, at the URL of ``self.channel``.
+
+    """
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ChannelHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.channel = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        ChannelHandler.statuses = []
+        ChannelHandler.truncate = False
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        ChannelHandler.truncate = False
@@ -0,0 +1,71 @@
+import json
+import os
+import unittest
+
+from conda_gitenv.clone import clone_prefix
+from conda_gitenv.resolve import tempdir
+
+
+PLACEHOLDER = '/opt/anaconda1anaconda2anaconda3'
+
+
+def write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def add_package(pkgs_dir, source, name, files, has_prefix=(), noarch=None):
+    # Add an extracted package to the package cache, and "link" it into
+    # the source prefix.
+    dist_name = '{}-1-0'.format(name)
+    extracted = os.path.join(pkgs_dir, dist_name)
+    write_file(os.path.join(extracted, 'info', 'index.json'), '{}')
+    write_file(os.path.join(extracted, 'info', 'has_prefix'),
+               ''.join('{} text {}\n'.format(PLACEHOLDER, path)
+                       for path in has_prefix))
+    for path in files:
+        content = PLACEHOLDER if path in has_prefix else path
+        write_file(os.path.join(extracted, path), content)
+        write_file(os.path.join(source, path),
+                   content.replace(PLACEHOLDER, source))
+    meta = {'name': name, 'files': files}
+    if noarch:
+        meta['noarch'] = noarch
+    write_file(os.path.join(source, 'conda-meta', dist_name + '.json'),
+               json.dumps(meta))
+    return dist_name
+
+
+class Test_clone_prefix(unittest.TestCase):
+    def test(self):
+        with tempdir() as pkgs_dir, tempdir() as deployed:
+            source = os.path.join(deployed, 'env', '1')
+            target = os.path.join(deployed, 'env', '2')
+            foo = add_package(pkgs_dir, source, 'foo',
+                              ['lib/foo.so', 'bin/foo'],
+                              has_prefix=['bin/foo'])
+            bar = add_package(pkgs_dir, source, 'bar', ['site-packages/bar'],
+                              noarch='python')
+            baz = 'baz-1-0'
+
+            cloned = clone_prefix(source, target, [foo, bar, baz], pkgs_dir)
+            self.assertEqual(cloned, set([foo]))
+
+            # Plain files are hardlinked.
+            self.assertTrue(os.path.samefile(
+                os.path.join(source, 'lib', 'foo.so'),
+                os.path.join(target, 'lib', 'foo.so')))
+            # Files with the prefix embedded are rewritten for the target.
+            with open(os.path.join(target, 'bin', 'foo')) as fh:
+                self.assertEqual(fh.read(), target)
+            self.assertFalse(os.path.samefile(
+                os.path.join(source, 'bin', 'foo'),
+                os.path.join(target, 'bin', 'foo')))
+            self.assertEqual(os.listdir(os.path.join(target, 'conda-meta')),
+                             [foo + '.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
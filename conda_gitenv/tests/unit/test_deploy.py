@@ -1,11 +1,15 @@
 import contextlib
+import json
 import os
 import textwrap
 import unittest
 
+import conda.base.context
+from conda.models.channel import Channel
 from git import Repo
 from conda_gitenv import resolve, tag_dates, label_tag, deploy
 from conda_gitenv.tests.integration.setup_samples import create_repo
+from conda_gitenv.tests.unit.fixtures import assert_raises_regex
 
 
 class Test_tags_by_env(unittest.TestCase):
@@ -36,21 +40,290 @@ class Test_tags_by_env(unittest.TestCase):
                                  'testing2': ['env-testing2-1']})
 
 
-class Test_tags_by_label(unittest.TestCase):
-    def test_no_tags(self):
-        expected = {}
-        with resolve.tempdir() as labels_dir:
-            label_tag.write_labels(labels_dir, expected)
-            result = deploy.tags_by_label(labels_dir)
-        self.assertEqual(result, expected)
+class Test_tags_by_label_tree(unittest.TestCase):
+    def setUp(self):
+        self.repo = create_repo('label_tree')
+
+    def test_no_labels(self):
+        result = deploy.tags_by_label_tree(self.repo.head.commit)
+        self.assertEqual(result, {})
 
     def test_some(self):
-        expected = {'a': '123', 'abc123': 'foobar-again'}
-        with resolve.tempdir() as labels_dir:
-            label_tag.write_labels(labels_dir, expected)
-            result = deploy.tags_by_label(labels_dir)
+        expected = {'next': 'env-a-1', 'current': 'env-a-2'}
+        labels_dir = os.path.join(self.repo.working_dir, 'labels')
+        os.makedirs(labels_dir)
+        label_tag.write_labels(labels_dir, expected)
+        self.repo.index.add([os.path.join(labels_dir, '{}.txt'.format(label))
+                             for label in expected])
+        commit = self.repo.index.commit('Add labels.')
+        # Remove the files from the working tree, to be sure that the labels
+        # are read from the commit.
+        for label in expected:
+            os.remove(os.path.join(labels_dir, '{}.txt'.format(label)))
+        result = deploy.tags_by_label_tree(commit)
         self.assertEqual(result, expected)
 
 
+class Test_manifest_index(unittest.TestCase):
+    def test_subset(self):
+        index = {'a-1-0': {'name': 'a'}, 'b-1-0': {'name': 'b'}}
+        result = deploy.manifest_index(index, ['b-1-0'])
+        self.assertEqual(result, {'b-1-0': {'name': 'b'}})
+
+    def test_missing(self):
+        msg = 'not available: c-1-0'
+        with assert_raises_regex(self, ValueError, msg):
+            deploy.manifest_index({'a-1-0': {'name': 'a'}}, ['a-1-0', 'c-1-0'])
+
+
+class Test_dependency_sort(unittest.TestCase):
+    def test_chain(self):
+        index = {'c-1-0': {'name': 'c', 'depends': ['b >=1', 'python']},
+                 'b-1-0': {'name': 'b', 'depends': ['a 1.0 0']},
+                 'a-1-0': {'name': 'a', 'depends': []}}
+        result = deploy.dependency_sort(index)
+        self.assertEqual(result, ['a-1-0', 'b-1-0', 'c-1-0'])
+
+    def test_independent_by_name(self):
+        index = {'b-1-0': {'name': 'b'}, 'a-1-0': {'name': 'a'}}
+        result = deploy.dependency_sort(index)
+        self.assertEqual(result, ['a-1-0', 'b-1-0'])
+
+    def test_cycle(self):
+        index = {'a-1-0': {'name': 'a', 'depends': ['b']},
+                 'b-1-0': {'name': 'b', 'depends': ['a']},
+                 'c-1-0': {'name': 'c', 'depends': ['a']}}
+        result = deploy.dependency_sort(index)
+        self.assertEqual(result, ['a-1-0', 'b-1-0', 'c-1-0'])
+
+
+class Test_lock_index(unittest.TestCase):
+    records = [{'name': 'foo', 'fn': 'foo-1-0.tar.bz2', 'md5': 'abc',
+                'depends': [], 'schannel': 'chan', 'subdir': 'linux-64',
+                'url': 'https://example.com/chan/linux-64/foo-1-0.tar.bz2'}]
+
+    def test_credentials(self):
+        index = deploy.lock_index(self.records, api_user='u', api_key='k')
+        [(dist, record)] = index.items()
+        self.assertEqual(dist.dist_name, 'foo-1-0')
+        self.assertEqual(dist.channel, 'chan')
+        self.assertEqual(record['md5'], 'abc')
+        self.assertEqual(record['url'], 'https://u:k@example.com/chan/'
+                                        'linux-64/foo-1-0.tar.bz2')
+
+    def test_mirror(self):
+        mirror = 'file:///mirror'
+        index = deploy.lock_index(self.records, mirror=mirror)
+        [(dist, record)] = index.items()
+        self.assertEqual(record['url'],
+                         'file:///mirror/linux-64/foo-1-0.tar.bz2')
+        # The packages are of the mirror's channel, as conda's package
+        # cache will find them to be once downloaded.
+        self.assertEqual(dist.channel, Channel(mirror).canonical_name)
+        self.assertEqual(record['schannel'], dist.channel)
+
+
+class Test_package_cache(unittest.TestCase):
+    def test_restored(self):
+        orig_pkgs_dirs = conda.base.context.Context.pkgs_dirs
+        with self.assertRaises(ValueError):
+            with deploy.package_cache('/pkgs'):
+                self.assertEqual(conda.base.context.context.pkgs_dirs,
+                                 ('/pkgs',))
+                raise ValueError('Failed to link.')
+        self.assertIs(conda.base.context.Context.pkgs_dirs, orig_pkgs_dirs)
+
+
+class Test_deployed_marker(unittest.TestCase):
+    def test_not_deployed(self):
+        with resolve.tempdir() as prefix:
+            self.assertIsNone(deploy.read_deployed_marker(prefix))
+
+    def test_round_trip(self):
+        with resolve.tempdir() as prefix:
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            deploy.write_deployed_marker(prefix, 'abc123', ['foo-1-0'])
+            result = deploy.read_deployed_marker(prefix)
+        self.assertEqual(result, {'manifest_sha': 'abc123',
+                                  'packages': ['foo-1-0']})
+
+
+class Test_closest_prefix(unittest.TestCase):
+    def test(self):
+        with resolve.tempdir() as target:
+            for name, pkgs in [('1', ['a-1-0', 'b-1-0']),
+                               ('2', ['a-1-0', 'b-2-0', 'c-1-0']),
+                               ('3', ['d-1-0'])]:
+                prefix = os.path.join(target, 'env', name)
+                os.makedirs(os.path.join(prefix, 'conda-meta'))
+                deploy.write_deployed_marker(prefix, name, pkgs)
+            # Labels and undeployed prefixes are ignored.
+            os.symlink('3', os.path.join(target, 'env', 'latest'))
+            os.makedirs(os.path.join(target, 'env', '4'))
+
+            new = os.path.join(target, 'env', '5')
+            self.assertEqual(deploy.closest_prefix(new, ['b-2-0', 'c-1-0']),
+                             os.path.join(target, 'env', '2'))
+            self.assertIsNone(deploy.closest_prefix(new, ['e-1-0']))
+
+
+class Test_clone_base(unittest.TestCase):
+    def test_removed(self):
+        # The base prefix was garbage collected since the deploy was planned.
+        with resolve.tempdir() as target:
+            base = os.path.join(target, 'env', '1')
+            os.makedirs(os.path.join(base, 'conda-meta'))
+            new = os.path.join(target, 'env', '2')
+            pkgs_dir = os.path.join(target, deploy.PKG_CACHE_NAME)
+            self.assertEqual(deploy._clone_base(base, new, ['a-1-0'],
+                                                pkgs_dir),
+                             ['a-1-0'])
+            self.assertFalse(os.path.lexists(new))
+
+
+class Test_replace_symlink(unittest.TestCase):
+    def test(self):
+        with resolve.tempdir() as target:
+            label = os.path.join(target, 'current')
+            deploy.replace_symlink('1', label)
+            self.assertEqual(os.readlink(label), '1')
+            deploy.replace_symlink('2', label)
+            self.assertEqual(os.readlink(label), '2')
+            # No temporary symlinks are left behind.
+            self.assertEqual(os.listdir(target), ['current'])
+
+
+class Test_reuse_prefix(unittest.TestCase):
+    def test(self):
+        with resolve.tempdir() as target:
+            prefix = os.path.join(target, 'env', '1')
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            deploy.write_deployed_marker(prefix, 'abc123', ['foo-1-0'])
+            self.assertEqual(deploy.deployed_prefixes(target),
+                             {'abc123': prefix})
+
+            reused = os.path.join(target, 'other', '2')
+            deploy.reuse_prefix(prefix, reused)
+            self.assertEqual(os.readlink(reused),
+                             os.path.join(os.pardir, 'env', '1'))
+            self.assertEqual(deploy.read_deployed_marker(reused)['packages'],
+                             ['foo-1-0'])
+            # The reused prefix is not itself a candidate for reuse.
+            self.assertEqual(deploy.deployed_prefixes(target),
+                             {'abc123': prefix})
+
+    def test_removed(self):
+        with resolve.tempdir() as target:
+            prefix = os.path.join(target, 'env', '1')
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            reused = os.path.join(target, 'other', '2')
+            with self.assertRaises(RuntimeError):
+                deploy.reuse_prefix(prefix, reused)
+            self.assertFalse(os.path.lexists(reused))
+
+
+class Test_deploy_tag(unittest.TestCase):
+    def setUp(self):
+        self.repo = create_repo('deploy_tag')
+        manifest = os.path.join(self.repo.working_dir, 'env.manifest')
+        with open(manifest, 'w') as fh:
+            fh.write('http://example.com/channel\tfoo-1-0\n')
+        self.repo.index.add([manifest])
+        self.repo.index.commit('Add manifest.')
+        self.repo.create_tag('env-example-1')
+
+    def test_already_deployed(self):
+        commit = self.repo.tags['env-example-1'].commit
+        manifest_sha = (commit.tree / 'env.manifest').hexsha
+        with resolve.tempdir() as target:
+            prefix = os.path.join(target, 'example', '1')
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            deploy.write_deployed_marker(prefix, manifest_sha, ['foo-1-0'])
+            # There is no spec or channel to deploy from, so this would fail
+            # if the environment were not recognised as already deployed.
+            deploy.deploy_tag(self.repo, 'env-example-1', target)
+
+
+class Test_plan_deploy(unittest.TestCase):
+    def setUp(self):
+        self.repo = repo = create_repo('plan_deploy')
+        initial = repo.head.commit
+        repo.create_head('manifest/example').checkout()
+        records = [{'fn': 'foo-1-0.tar.bz2', 'size': 100},
+                   {'fn': 'bar-1-0.tar.bz2', 'size': 200}]
+        self.commit({'env.manifest': 'http://example.com/c\tfoo-1-0\n'
+                                     'http://example.com/c\tbar-1-0\n',
+                     'env.lock.json': json.dumps({'packages': records}),
+                     'env.spec': 'channels: []\n'})
+        repo.create_tag('env-example-1')
+        repo.create_head('example', initial).checkout()
+        self.commit({os.path.join('labels', 'current.txt'): 'env-example-1'})
+
+    def commit(self, files):
+        paths = []
+        for name, content in files.items():
+            path = os.path.join(self.repo.working_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write(content)
+            paths.append(path)
+        self.repo.index.add(paths)
+        self.repo.index.commit('Update.')
+
+    def test_new(self):
+        with resolve.tempdir() as target:
+            pkgs_dir = os.path.join(target, deploy.PKG_CACHE_NAME)
+            os.makedirs(pkgs_dir)
+            open(os.path.join(pkgs_dir, 'foo-1-0.tar.bz2'), 'w').close()
+
+            plan = deploy.plan_deploy(self.repo, target)
+            self.assertEqual([entry['tag'] for entry in plan['deploy']],
+                             ['env-example-1'])
+            self.assertEqual([(entry['label'], entry['current'],
+                               entry['target']) for entry in plan['labels']],
+                             [('current', None, '1'), ('latest', None, '1')])
+            self.assertEqual(plan['download']['packages'], ['bar-1-0'])
+            self.assertEqual(plan['download']['bytes'], 200)
+            self.assertEqual(plan['estimated_seconds'],
+                             round(200 / deploy.PLAN_DOWNLOAD_RATE +
+                                   2 * deploy.PLAN_LINK_TIME, 1))
+            summary = json.loads(deploy.plan_json(plan))
+            self.assertEqual(summary['deploy'][0]['packages'], 2)
+            # The target is left alone.
+            self.assertEqual(os.listdir(target), [deploy.PKG_CACHE_NAME])
+
+    def test_deployed(self):
+        commit = self.repo.tags['env-example-1'].commit
+        with resolve.tempdir() as target:
+            prefix = os.path.join(target, 'example', '1')
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            deploy.write_deployed_marker(
+                prefix, (commit.tree / 'env.manifest').hexsha,
+                ['bar-1-0', 'foo-1-0'])
+            os.symlink('1', os.path.join(target, 'example', 'current'))
+
+            plan = deploy.plan_deploy(self.repo, target)
+            self.assertEqual(plan['deploy'], [])
+            self.assertEqual([(entry['label'], entry['current'])
+                              for entry in plan['labels']],
+                             [('current', '1'), ('latest', None)])
+            self.assertEqual(plan['estimated_seconds'], 0)
+            # Planning takes no locks, which would leave files behind.
+            self.assertEqual(sorted(os.listdir(os.path.join(target,
+                                                            'example'))),
+                             ['1', 'current'])
+
+    def test_env_labels(self):
+        with resolve.tempdir() as target:
+            plan = deploy.plan_deploy(self.repo, target,
+                                      env_labels=['other/*'])
+            self.assertEqual(plan['deploy'], [])
+            self.assertEqual(plan['labels'], [])
+            # The labels which aren't being deployed keep their packages.
+            self.assertEqual(plan['protected'],
+                             [os.path.join('example', '1')])
+
+
 if __name__ == '__main__':
     unittest.main()
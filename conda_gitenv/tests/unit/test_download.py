@@ -0,0 +1,149 @@
+import hashlib
+import os
+import unittest
+
+from conda_gitenv.download import (download_packages, file_md5,
+                                   stream_packages)
+from conda_gitenv.extract import extract_packages, is_extracted
+from conda_gitenv.resolve import tempdir
+from conda_gitenv.tests.unit.fixtures import (ChannelHandler,
+                                              ChannelServerMixin,
+                                              assert_raises_regex,
+                                              write_package)
+
+
+class Test_download_packages(ChannelServerMixin, unittest.TestCase):
+    def index(self, channel_dir, md5=None):
+        index = {}
+        for name in ['foo', 'bar']:
+            fn = '{}-1-0.tar.bz2'.format(name)
+            content = name.encode('ascii') * 1000
+            with open(os.path.join(channel_dir, fn), 'wb') as fh:
+                fh.write(content)
+            index[name] = {'fn': fn, 'url': self.channel + fn,
+                           'md5': md5 or hashlib.md5(content).hexdigest()}
+        return index
+
+    def test_download(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir)
+            download_packages(index, sorted(index), pkgs_dir, jobs=2)
+            self.assertEqual(ChannelHandler.statuses, [200, 200])
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['bar-1-0.tar.bz2', 'foo-1-0.tar.bz2',
+                              'urls.txt'])
+            with open(os.path.join(pkgs_dir, 'urls.txt')) as fh:
+                urls = sorted(fh.read().splitlines())
+            self.assertEqual(urls, [self.channel + 'bar-1-0.tar.bz2',
+                                    self.channel + 'foo-1-0.tar.bz2'])
+
+            # Cached packages aren't downloaded again.
+            ChannelHandler.statuses = []
+            download_packages(index, sorted(index), pkgs_dir, jobs=2)
+            self.assertEqual(ChannelHandler.statuses, [])
+
+    def test_extracted(self):
+        # A package whose tarball was evicted isn't downloaded again.
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir)
+            write_package(pkgs_dir, 'foo-1-0.tar.bz2')
+            extract_packages(index, ['foo'], pkgs_dir)
+            os.remove(os.path.join(pkgs_dir, 'foo-1-0.tar.bz2'))
+            download_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(ChannelHandler.statuses, [])
+
+    def test_md5_mismatch(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir, md5='0' * 32)
+            with assert_raises_regex(self, ValueError, 'MD5 mismatch'):
+                download_packages(index, ['foo'], pkgs_dir)
+            self.assertNotIn('foo-1-0.tar.bz2', os.listdir(pkgs_dir))
+
+    def test_interrupted(self):
+        # A download which fails part way through leaves nothing behind.
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            ChannelHandler.truncate = True
+            index = self.index(channel_dir)
+            with self.assertRaises(Exception):
+                download_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(os.listdir(pkgs_dir), ['urls.txt'])
+
+
+class Test_stream_packages(ChannelServerMixin, unittest.TestCase):
+    def index(self, channel_dir, md5=None):
+        fn = 'foo-1-0.tar.bz2'
+        write_package(channel_dir, fn)
+        md5 = md5 or file_md5(os.path.join(channel_dir, fn))
+        return {'foo': {'fn': fn, 'url': self.channel + fn, 'md5': md5}}
+
+    def test_download(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir)
+            stream_packages(index, ['foo'], pkgs_dir)
+            self.assertTrue(is_extracted(os.path.join(pkgs_dir, 'foo-1-0')))
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['foo-1-0', 'urls.txt'])
+
+            # Extracted packages aren't downloaded again.
+            ChannelHandler.statuses = []
+            stream_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(ChannelHandler.statuses, [])
+
+    def test_incomplete(self):
+        # An incomplete extraction left behind is replaced.
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir)
+            os.makedirs(os.path.join(pkgs_dir, 'foo-1-0', 'lib'))
+            os.makedirs(os.path.join(pkgs_dir, 'foo-1-0.partial', 'info'))
+            stream_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['foo-1-0', 'urls.txt'])
+            self.assertEqual(os.listdir(os.path.join(pkgs_dir, 'foo-1-0')),
+                             ['info'])
+
+    def test_interrupted(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            ChannelHandler.truncate = True
+            index = self.index(channel_dir)
+            with self.assertRaises(Exception):
+                stream_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(os.listdir(pkgs_dir), ['urls.txt'])
+
+    def test_interrupted_keep_tarballs(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            ChannelHandler.truncate = True
+            index = self.index(channel_dir)
+            with self.assertRaises(Exception):
+                stream_packages(index, ['foo'], pkgs_dir, keep_tarballs=True)
+            self.assertEqual(os.listdir(pkgs_dir), ['urls.txt'])
+
+    def test_keep_tarballs(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir)
+            stream_packages(index, ['foo'], pkgs_dir, keep_tarballs=True)
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['foo-1-0', 'foo-1-0.tar.bz2', 'urls.txt'])
+            self.assertEqual(file_md5(os.path.join(pkgs_dir,
+                                                   'foo-1-0.tar.bz2')),
+                             index['foo']['md5'])
+
+    def test_md5_mismatch(self):
+        with tempdir() as channel_dir, tempdir() as pkgs_dir:
+            ChannelHandler.root = channel_dir
+            index = self.index(channel_dir, md5='0' * 32)
+            with assert_raises_regex(self, ValueError, 'MD5 mismatch'):
+                stream_packages(index, ['foo'], pkgs_dir, keep_tarballs=True)
+            self.assertEqual(os.listdir(pkgs_dir), ['urls.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
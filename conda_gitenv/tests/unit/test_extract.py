@@ -0,0 +1,67 @@
+import os
+import unittest
+
+from conda_gitenv.extract import (dist_name, extract_packages, is_extracted,
+                                  legacy_url)
+from conda_gitenv.resolve import tempdir
+from conda_gitenv.tests.unit.fixtures import (assert_raises_regex,
+                                              write_package)
+
+
+class Test_dist_name(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(dist_name('foo-1-0.tar.bz2'), 'foo-1-0')
+        self.assertEqual(dist_name('foo-1-0.conda'), 'foo-1-0')
+
+    def test_unknown(self):
+        with assert_raises_regex(self, ValueError, 'Unknown package archive'):
+            dist_name('foo-1-0.zip')
+
+
+class Test_legacy_url(unittest.TestCase):
+    def test(self):
+        self.assertEqual(legacy_url('https://example.com/c/foo-1-0.conda'),
+                         'https://example.com/c/foo-1-0.tar.bz2')
+
+
+class Test_extract_packages(unittest.TestCase):
+    def test_extract(self):
+        index = {'foo': {'fn': 'foo-1-0.tar.bz2'},
+                 'bar': {'fn': 'bar-1-0.tar.bz2'},
+                 'baz': {'fn': 'baz-1-0.tar.bz2'}}
+        with tempdir() as pkgs_dir:
+            write_package(pkgs_dir, 'foo-1-0.tar.bz2')
+            write_package(pkgs_dir, 'bar-1-0.tar.bz2')
+            extract_packages(index, sorted(index), pkgs_dir, jobs=2)
+            self.assertTrue(is_extracted(os.path.join(pkgs_dir, 'foo-1-0')))
+            self.assertTrue(is_extracted(os.path.join(pkgs_dir, 'bar-1-0')))
+            # Packages which haven't been downloaded are left alone.
+            self.assertFalse(os.path.exists(os.path.join(pkgs_dir,
+                                                         'baz-1-0')))
+
+    def test_incomplete(self):
+        index = {'foo': {'fn': 'foo-1-0.tar.bz2'}}
+        with tempdir() as pkgs_dir:
+            write_package(pkgs_dir, 'foo-1-0.tar.bz2')
+            # Left behind by an interrupted extraction.
+            os.makedirs(os.path.join(pkgs_dir, 'foo-1-0', 'lib'))
+            os.makedirs(os.path.join(pkgs_dir, 'foo-1-0.partial', 'info'))
+            extract_packages(index, ['foo'], pkgs_dir)
+            self.assertTrue(is_extracted(os.path.join(pkgs_dir, 'foo-1-0')))
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['foo-1-0', 'foo-1-0.tar.bz2'])
+            self.assertEqual(os.listdir(os.path.join(pkgs_dir, 'foo-1-0')),
+                             ['info'])
+
+    def test_failed(self):
+        index = {'foo': {'fn': 'foo-1-0.tar.bz2'}}
+        with tempdir() as pkgs_dir:
+            with open(os.path.join(pkgs_dir, 'foo-1-0.tar.bz2'), 'wb') as fh:
+                fh.write(b'Not a tarball.')
+            with self.assertRaises(Exception):
+                extract_packages(index, ['foo'], pkgs_dir)
+            self.assertEqual(os.listdir(pkgs_dir), ['foo-1-0.tar.bz2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
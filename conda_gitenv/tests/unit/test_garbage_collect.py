@@ -0,0 +1,116 @@
+import os
+import unittest
+
+from conda_gitenv import deploy, resolve
+from conda_gitenv.garbage_collect import (gc_repo, reclaimable_bytes,
+                                          remove_prefix,
+                                          unreferenced_prefixes)
+from conda_gitenv.tests.integration.setup_samples import create_repo
+
+
+class Test_unreferenced_prefixes(unittest.TestCase):
+    def setUp(self):
+        self.repo = repo = create_repo('garbage_collect')
+        initial = repo.head.commit
+        for env_name, count, label in [('example', 4, 'env-example-1'),
+                                       ('other', 2, 'env-other-1')]:
+            repo.create_head('manifest/' + env_name, initial)
+            for number in range(count):
+                commit = repo.index.commit(
+                    'Manifest.', head=False, parent_commits=[initial],
+                    commit_date='2017-01-0{}T00:00:00'.format(number + 1))
+                repo.create_tag('env-{}-{}'.format(env_name, number), commit)
+            repo.create_head(env_name, initial).checkout()
+            path = os.path.join(repo.working_dir, 'labels', 'current.txt')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write(label)
+            repo.index.add([path])
+            repo.index.commit('Label.')
+
+    def deploy(self, target):
+        for number in range(4):
+            prefix = os.path.join(target, 'example', str(number))
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            deploy.write_deployed_marker(prefix, str(number), [])
+        os.symlink('1', os.path.join(target, 'example', 'current'))
+        os.symlink('3', os.path.join(target, 'example', 'latest'))
+        # The other environment's prefixes reuse those of the example.
+        os.makedirs(os.path.join(target, 'other'))
+        for number, reused in [(0, '0'), (1, '2')]:
+            os.symlink(os.path.join(os.pardir, 'example', reused),
+                       os.path.join(target, 'other', str(number)))
+        os.symlink('1', os.path.join(target, 'other', 'current'))
+
+    def listdir(self, env_dir):
+        # The prefixes of the environment directory, ignoring the lock
+        # files left alongside them by conda.
+        return sorted(name for name in os.listdir(env_dir)
+                      if not name.startswith('.'))
+
+    def test(self):
+        with resolve.tempdir() as target:
+            self.deploy(target)
+            # The example's unlabelled prefix 2 is kept, as it is reused by
+            # the other environment's labelled prefix.
+            target = os.path.abspath(target)
+            self.assertEqual(unreferenced_prefixes(self.repo, target),
+                             [os.path.join(target, 'example', '0'),
+                              os.path.join(target, 'other', '0')])
+
+    def test_keep(self):
+        with resolve.tempdir() as target:
+            self.deploy(target)
+            self.assertEqual(unreferenced_prefixes(self.repo, target,
+                                                   keep=4), [])
+
+    def test_gc(self):
+        with resolve.tempdir() as target:
+            self.deploy(target)
+            gc_repo(self.repo, target, jobs=2)
+            self.assertEqual(self.listdir(os.path.join(target, 'example')),
+                             ['1', '2', '3', 'current', 'latest'])
+            self.assertEqual(self.listdir(os.path.join(target, 'other')),
+                             ['1', 'current'])
+
+    def test_reused_since(self):
+        with resolve.tempdir() as target:
+            self.deploy(target)
+            target = os.path.abspath(target)
+            prefixes = unreferenced_prefixes(self.repo, target)
+            # A deployment reuses one of the prefixes after it was found to
+            # be unreferenced.
+            os.symlink(os.path.join(os.pardir, 'example', '0'),
+                       os.path.join(target, 'other', '3'))
+            example, other = prefixes
+            self.assertIsNone(remove_prefix(example, target, prefixes))
+            self.assertEqual(remove_prefix(other, target, prefixes), other)
+            self.assertTrue(os.path.isdir(example))
+            self.assertFalse(os.path.lexists(other))
+
+    def test_dry_run(self):
+        with resolve.tempdir() as target:
+            self.deploy(target)
+            prefixes, _ = gc_repo(self.repo, target, dry_run=True)
+            self.assertEqual(len(prefixes), 2)
+            self.assertTrue(all(os.path.lexists(prefix)
+                                for prefix in prefixes))
+
+
+class Test_reclaimable_bytes(unittest.TestCase):
+    def test_hardlinks(self):
+        with resolve.tempdir() as target:
+            prefix = os.path.join(target, 'example', '1')
+            os.makedirs(prefix)
+            with open(os.path.join(prefix, 'own'), 'w') as fh:
+                fh.write('a' * 10)
+            with open(os.path.join(target, 'cached'), 'w') as fh:
+                fh.write('b' * 5)
+            os.link(os.path.join(target, 'cached'),
+                    os.path.join(prefix, 'shared'))
+            self.assertEqual(reclaimable_bytes([prefix]), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import unittest
+
+from conda.models.dist import Dist
+
+from conda_gitenv.index import IndexRegistry, subdir_packages
+from conda_gitenv.resolve import tempdir
+from conda_gitenv.tests.unit.fixtures import (ChannelHandler,
+                                              ChannelServerMixin)
+from conda_build_all.tests.unit import dummy_index
+
+
+def dummy_channel(directory):
+    index = dummy_index.DummyIndex()
+    index.add_pkg('foo', '3.5.0', depends=('bar',), build_number=0)
+    index.add_pkg('bar', '1.2', build_number=0)
+    index.write_to_channel(directory)
+
+
+class Test_IndexRegistry(unittest.TestCase):
+    def test_shared_index(self):
+        registry = IndexRegistry()
+        with tempdir() as tmp:
+            dummy_channel(tmp)
+            channels = ['file://{}'.format(tmp)]
+            first = registry.get_index(channels)
+            n_subdirs = registry.misses
+            second = registry.get_index(list(channels))
+        self.assertIs(first, second)
+        self.assertGreater(n_subdirs, 0)
+        self.assertEqual(registry.misses, n_subdirs)
+        self.assertEqual(registry.hits, n_subdirs)
+        pkg_names = sorted(info['name'] for info in first.values())
+        self.assertEqual(pkg_names, ['bar', 'foo'])
+
+
+class Test_subdir_packages(unittest.TestCase):
+    def test_prefer_conda_format(self):
+        info = {'name': 'foo', 'version': '1', 'build': '0',
+                'build_number': 0, 'depends': []}
+        url = 'https://example.com/chan/linux-64'
+        tar_bz2 = Dist.from_string('foo-1-0', channel_override='chan')
+        repodata = {'packages': {tar_bz2: dict(info, fn='foo-1-0.tar.bz2')},
+                    'packages.conda': {'foo-1-0.conda': dict(info),
+                                       'bar-1-0.conda': dict(info,
+                                                             name='bar')}}
+        packages = subdir_packages(repodata, url, 'chan', 0)
+        self.assertEqual(sorted(record['fn'] for record in packages.values()),
+                         ['bar-1-0.conda', 'foo-1-0.conda'])
+        self.assertEqual(packages[tar_bz2]['url'], url + '/foo-1-0.conda')
+
+
+class Test_IndexRegistry_cache_dir(ChannelServerMixin, unittest.TestCase):
+    def get_index(self, cache_dir, max_age=None):
+        ChannelHandler.statuses = []
+        registry = IndexRegistry(cache_dir=cache_dir, max_age=max_age)
+        index = registry.get_index([self.channel])
+        return sorted(info['name'] for info in index.values())
+
+    def test_revalidation(self):
+        with tempdir() as channel_dir, tempdir() as cache_dir:
+            dummy_channel(channel_dir)
+            ChannelHandler.root = channel_dir
+
+            # A cold cache fetches the full repodata.
+            self.assertEqual(self.get_index(cache_dir), ['bar', 'foo'])
+            self.assertIn(200, ChannelHandler.statuses)
+            self.assertNotIn(304, ChannelHandler.statuses)
+
+            # A warm cache is revalidated with conditional requests.
+            self.assertEqual(self.get_index(cache_dir), ['bar', 'foo'])
+            self.assertIn(304, ChannelHandler.statuses)
+            self.assertNotIn(200, ChannelHandler.statuses)
+
+            # A young enough cache isn't revalidated at all.
+            self.assertEqual(self.get_index(cache_dir, max_age=3600),
+                             ['bar', 'foo'])
+            self.assertNotIn(200, ChannelHandler.statuses)
+            self.assertNotIn(304, ChannelHandler.statuses)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from conda_gitenv.extract import is_extracted
+from conda_gitenv.pkg_cache import (IN_USE_MAX_AGE, IN_USE_PREFIX,
+                                    cached_packages, evict_packages, in_use,
+                                    mark_used)
+from conda_gitenv.resolve import tempdir
+
+
+def add_package(pkgs_dir, name, size, extracted=True, tarball=True,
+                last_used=0):
+    paths = []
+    if tarball:
+        paths.append(os.path.join(pkgs_dir, name + '.tar.bz2'))
+        with open(paths[-1], 'wb') as fh:
+            fh.write(b'x' * size)
+    if extracted:
+        info = os.path.join(pkgs_dir, name, 'info')
+        os.makedirs(info)
+        with open(os.path.join(info, 'index.json'), 'wb') as fh:
+            fh.write(b'x' * size)
+        paths.append(os.path.join(pkgs_dir, name))
+    for path in paths:
+        os.utime(path, (last_used, last_used))
+
+
+class Test_cached_packages(unittest.TestCase):
+    def test(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10)
+            add_package(pkgs_dir, 'bar-1-0', 10, tarball=False)
+            open(os.path.join(pkgs_dir, 'urls.txt'), 'w').close()
+            packages = cached_packages(pkgs_dir)
+            self.assertEqual(sorted(packages), ['bar-1-0', 'foo-1-0'])
+            self.assertEqual(len(packages['foo-1-0']), 2)
+
+
+class Test_evict_packages(unittest.TestCase):
+    def test_within_budget(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10)
+            self.assertEqual(evict_packages(pkgs_dir, 20), [])
+
+    def test_tarballs_first(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10, last_used=1)
+            add_package(pkgs_dir, 'bar-1-0', 10, last_used=2)
+            removed = evict_packages(pkgs_dir, 30)
+            self.assertEqual(removed,
+                             [os.path.join(pkgs_dir, 'foo-1-0.tar.bz2')])
+            self.assertTrue(is_extracted(os.path.join(pkgs_dir, 'foo-1-0')))
+
+    def test_lru(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10, tarball=False, last_used=1)
+            add_package(pkgs_dir, 'bar-1-0', 10, tarball=False, last_used=2)
+            add_package(pkgs_dir, 'baz-1-0', 10, tarball=False, last_used=3)
+            evict_packages(pkgs_dir, 20, protected=['foo-1-0'])
+            self.assertEqual(sorted(cached_packages(pkgs_dir)),
+                             ['baz-1-0', 'foo-1-0'])
+
+    def test_tarballs_only(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10)
+            add_package(pkgs_dir, 'bar-1-0', 10, extracted=False)
+            evict_packages(pkgs_dir, 0, tarballs_only=True)
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             ['bar-1-0.tar.bz2', 'foo-1-0'])
+
+    def test_mark_used(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10, tarball=False, last_used=1)
+            add_package(pkgs_dir, 'bar-1-0', 10, tarball=False, last_used=2)
+            mark_used(pkgs_dir, ['foo-1-0'])
+            self.assertGreater(os.path.getmtime(os.path.join(pkgs_dir,
+                                                             'foo-1-0')),
+                               time.time() - 60)
+            evict_packages(pkgs_dir, 10)
+            self.assertEqual(list(cached_packages(pkgs_dir)), ['foo-1-0'])
+
+    def test_in_use(self):
+        with tempdir() as pkgs_dir:
+            add_package(pkgs_dir, 'foo-1-0', 10, tarball=False, last_used=1)
+            add_package(pkgs_dir, 'bar-1-0', 10, tarball=False, last_used=2)
+            with in_use(pkgs_dir, ['foo-1-0']):
+                evict_packages(pkgs_dir, 10)
+                self.assertEqual(list(cached_packages(pkgs_dir)),
+                                 ['foo-1-0'])
+            # Nothing is left behind once the packages are no longer in use.
+            self.assertEqual(os.listdir(pkgs_dir), ['foo-1-0'])
+
+    def write_in_use(self, pkgs_dir, name, host, pid, age=0):
+        path = os.path.join(pkgs_dir, IN_USE_PREFIX + name)
+        with open(path, 'w') as fh:
+            json.dump({'host': host, 'pid': pid, 'packages': [name]}, fh)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_stale_in_use(self):
+        # A process which has since exited.
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        host = socket.gethostname()
+        with tempdir() as pkgs_dir:
+            for name in ['foo-1-0', 'bar-1-0', 'baz-1-0']:
+                add_package(pkgs_dir, name, 10, tarball=False, last_used=1)
+            # Left behind by deployments which crashed, on this host and
+            # on another.
+            self.write_in_use(pkgs_dir, 'foo-1-0', host, process.pid)
+            self.write_in_use(pkgs_dir, 'bar-1-0', 'elsewhere', os.getpid(),
+                              age=IN_USE_MAX_AGE + 60)
+            # Still in use on another host.
+            self.write_in_use(pkgs_dir, 'baz-1-0', 'elsewhere', os.getpid())
+            evict_packages(pkgs_dir, 10)
+            self.assertEqual(list(cached_packages(pkgs_dir)), ['baz-1-0'])
+            self.assertEqual(sorted(os.listdir(pkgs_dir)),
+                             [IN_USE_PREFIX + 'baz-1-0', 'baz-1-0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
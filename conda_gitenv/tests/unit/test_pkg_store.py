@@ -0,0 +1,65 @@
+import os
+import unittest
+
+from conda_gitenv.extract import extract_packages, is_extracted
+from conda_gitenv.pkg_store import (fetch_from_stores, in_stores,
+                                    populate_stores)
+from conda_gitenv.resolve import tempdir
+from conda_gitenv.tests.unit.fixtures import write_package
+
+
+class Test_populate_stores(unittest.TestCase):
+    index = {'foo': {'fn': 'foo-1-0.tar.bz2', 'md5': 'abc123',
+                     'url': 'http://example.com/c/foo-1-0.tar.bz2'}}
+
+    def test_round_trip(self):
+        with tempdir() as pkgs_dir, tempdir() as store, \
+                tempdir() as other_pkgs_dir:
+            write_package(pkgs_dir, 'foo-1-0.tar.bz2')
+            extract_packages(self.index, ['foo'], pkgs_dir)
+            self.assertFalse(in_stores([store], self.index['foo']))
+            populate_stores(self.index, ['foo'], pkgs_dir, [store])
+            self.assertTrue(in_stores([store], self.index['foo']))
+            self.assertEqual(sorted(os.listdir(os.path.join(store,
+                                                            'abc123'))),
+                             ['foo-1-0', 'foo-1-0.tar.bz2'])
+
+            found = fetch_from_stores(self.index, ['foo'], other_pkgs_dir,
+                                      [store])
+            self.assertEqual(found, ['foo'])
+            # The extracted package is hardlinked from the store.
+            index_json = os.path.join('foo-1-0', 'info', 'index.json')
+            self.assertTrue(os.path.samefile(
+                os.path.join(store, 'abc123', index_json),
+                os.path.join(other_pkgs_dir, index_json)))
+            with open(os.path.join(other_pkgs_dir, 'urls.txt')) as fh:
+                self.assertEqual(fh.read().splitlines(),
+                                 [self.index['foo']['url']])
+
+            # Cached packages aren't linked again.
+            self.assertEqual(fetch_from_stores(self.index, ['foo'],
+                                               other_pkgs_dir, [store]), [])
+
+    def test_tiers(self):
+        # The first store to have the package is used.
+        with tempdir() as pkgs_dir, tempdir() as local, \
+                tempdir() as shared:
+            os.mkdir(os.path.join(shared, 'abc123'))
+            write_package(shared, os.path.join('abc123', 'foo-1-0.tar.bz2'))
+            found = fetch_from_stores(self.index, ['foo'], pkgs_dir,
+                                      [local, shared])
+            self.assertEqual(found, ['foo'])
+            self.assertTrue(os.path.isfile(os.path.join(pkgs_dir,
+                                                        'foo-1-0.tar.bz2')))
+            self.assertFalse(is_extracted(os.path.join(pkgs_dir, 'foo-1-0')))
+
+    def test_no_md5(self):
+        index = {'foo': {'fn': 'foo-1-0.tar.bz2'}}
+        with tempdir() as pkgs_dir, tempdir() as store:
+            write_package(pkgs_dir, 'foo-1-0.tar.bz2')
+            populate_stores(index, ['foo'], pkgs_dir, [store])
+            self.assertEqual(os.listdir(store), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
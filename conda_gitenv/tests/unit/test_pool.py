@@ -0,0 +1,67 @@
+import argparse
+import unittest
+
+from conda_gitenv.index import IndexRegistry
+from conda_gitenv.pool import pool_imap, positive_int, worker_state
+
+
+def _double(task):
+    return task * 2
+
+
+def _lookup(task):
+    # Stand in for a worker making index lookups on its registry.
+    index_registry = worker_state()
+    counts = index_registry.counts()
+    index_registry.hits += task
+    index_registry.misses += 1
+    return index_registry.take_counts(counts)
+
+
+class Test_pool_imap(unittest.TestCase):
+    def test_ordered(self):
+        for jobs in [1, 3]:
+            with pool_imap(_double, list(range(10)), jobs=jobs,
+                           ordered=True) as results:
+                self.assertEqual(list(results), list(range(0, 20, 2)))
+
+    def test_threads(self):
+        with pool_imap(_double, list(range(10)), jobs=3,
+                       threads=True) as results:
+            self.assertEqual(sorted(results), list(range(0, 20, 2)))
+
+    def test_failed(self):
+        with self.assertRaises(TypeError):
+            with pool_imap(_double, [1, None], jobs=2) as results:
+                list(results)
+
+    def test_counts(self):
+        # The lookups of each worker are added up, whether or not the
+        # tasks are run in a pool.
+        for jobs in [1, 2]:
+            index_registry = IndexRegistry()
+            index_registry.add_counts((1, 1))
+            with pool_imap(_lookup, [1, 2, 3], jobs=jobs,
+                           state=index_registry) as results:
+                for counts in results:
+                    index_registry.add_counts(counts)
+            self.assertEqual(index_registry.counts(), (7, 4))
+
+
+class Test_positive_int(unittest.TestCase):
+    def test(self):
+        self.assertEqual(positive_int('3'), 3)
+        for value in ['0', '-1']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                positive_int(value)
+
+    def test_parser(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--jobs', type=positive_int, default=1)
+        self.assertEqual(parser.parse_args(['--jobs', '2']).jobs, 2)
+        with self.assertRaises(SystemExit):
+            parser.parse_args(['--jobs', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
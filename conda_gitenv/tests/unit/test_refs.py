@@ -0,0 +1,50 @@
+import unittest
+
+from conda_gitenv.refs import RefSnapshot
+from conda_gitenv.tests.integration.setup_samples import create_repo
+
+
+class Test_RefSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.repo = create_repo('ref_snapshot')
+
+    def test_branches(self):
+        self.repo.create_head('manifest/example_env')
+        refs = RefSnapshot(self.repo)
+        self.assertEqual(sorted(refs.branches),
+                         ['manifest/example_env', 'master'])
+        branch = refs.branches['manifest/example_env']
+        commit = self.repo.head.commit
+        self.assertEqual(branch.path, 'refs/heads/manifest/example_env')
+        self.assertEqual(branch.commit_sha, commit.hexsha)
+        self.assertEqual(branch.committed_date, commit.committed_date)
+
+    def test_tags(self):
+        commit = self.repo.head.commit
+        self.repo.create_tag('env-lightweight-1')
+        self.repo.create_tag('env-annotated-1', message='Annotated.')
+        refs = RefSnapshot(self.repo)
+        lightweight = refs.tags['env-lightweight-1']
+        annotated = refs.tags['env-annotated-1']
+        self.assertEqual(lightweight.object_type, 'commit')
+        self.assertEqual(annotated.object_type, 'tag')
+        # Annotated tags are peeled to their commit.
+        for tag in [lightweight, annotated]:
+            self.assertEqual(tag.commit_sha, commit.hexsha)
+            self.assertEqual(tag.committed_date, commit.committed_date)
+        self.assertEqual(sorted(tag.name for tag in
+                                refs.tags_by_commit()[commit.hexsha]),
+                         ['env-annotated-1', 'env-lightweight-1'])
+
+    def test_non_commit_tags(self):
+        self.repo.create_tag('env-annotated-1', message='Annotated.')
+        # Tags which don't point to a commit, and so have no committed date.
+        tree = self.repo.head.commit.tree.hexsha
+        self.repo.git.tag('tree-lightweight', tree)
+        self.repo.git.tag('-a', 'tree-annotated', '-m', 'Annotated.', tree)
+        refs = RefSnapshot(self.repo)
+        self.assertEqual(list(refs.tags), ['env-annotated-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()